@@ -0,0 +1,169 @@
+"""
+Run scUNC over a manifest of datasets x seeds x hyperparameters on a process pool.
+
+Manifest (JSON):
+    {
+        "datasets": ["SMAGE3K"],
+        "seeds": [0, 1, 2],
+        "params": [{"dip_merge_threshold": 0.9}, {"dip_merge_threshold": 1.0}],
+        "defaults": {"pretrain_epochs": 100, "dedc_epochs": 50},
+        "cache": "float32"
+    }
+
+With "cache" the datasets are read from the memory-mapped binary cache of load_data (float32 or
+float16), which is built once and shared by all workers through the page cache.
+
+Every finished job is appended to the results table right away, so restarting the
+runner with the same results file skips the jobs that are already done.
+"""
+import argparse
+import csv
+import hashlib
+import itertools
+import json
+import os
+import time
+
+# numpy/torch are only imported inside the workers, after their thread limits are set
+RESULT_FIELDS = ["job_id", "dataset", "seed", "cache", "params", "ari", "nmi", "acc", "pur", "n_clusters",
+                 "load_time", "fit_time", "total_time"]
+
+DEFAULT_PARAMS = dict(dip_merge_threshold=1, cluster_loss_weight=0.1, ae_loss_weight=100, batch_size=1024,
+                      learning_rate=1e-4, pretrain_epochs=100, dedc_epochs=50, embedding_size=100,
+                      n_clusters_max=float('inf'), n_clusters_min=3, debug=False)
+
+
+def load_manifest(path):
+    with open(path) as f:
+        manifest = json.load(f)
+    jobs = []
+    defaults = dict(DEFAULT_PARAMS, **manifest.get("defaults", {}))
+    for dataset, seed, params in itertools.product(manifest["datasets"], manifest.get("seeds", [0]),
+                                                   manifest.get("params", [{}])):
+        params = dict(defaults, **params)
+        cache = manifest.get("cache")
+        jobs.append(dict(job_id=get_job_id(dataset, seed, params, cache), dataset=dataset, seed=seed, params=params,
+                         cache=cache))
+    return jobs
+
+
+def get_job_id(dataset, seed, params, cache=None):
+    # The cache dtype changes the input data, so runs with different caches are different jobs
+    key = json.dumps(dict(params=params, cache=cache), sort_keys=True)
+    return "{0}-seed{1}-{2}".format(dataset, seed, hashlib.md5(key.encode()).hexdigest()[:8])
+
+
+def get_finished_jobs(results_path):
+    if not os.path.isfile(results_path):
+        return set()
+    with open(results_path, newline="") as f:
+        return {row["job_id"] for row in csv.DictReader(f)}
+
+
+def append_result(results_path, row):
+    new_file = not os.path.isfile(results_path)
+    fieldnames = RESULT_FIELDS
+    if not new_file:
+        # Keep the columns of a results file written by an older version
+        with open(results_path, newline="") as f:
+            fieldnames = next(csv.reader(f), RESULT_FIELDS)
+    with open(results_path, "a", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction="ignore")
+        if new_file:
+            writer.writeheader()
+        writer.writerow(row)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def init_worker(threads_per_job):
+    # Must run before numpy/torch are imported in this process
+    from parallel import blas_thread_env, configure_threads
+    os.environ.update(blas_thread_env(threads_per_job))
+    configure_threads(torch_threads=threads_per_job, torch_interop_threads=1, blas_threads=threads_per_job,
+                      dip_workers=1)
+
+
+def set_seed(seed):
+    import random
+    import numpy as np
+    import torch
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+
+def run_job(job):
+    import numpy as np
+    import load_data as loader
+    from run_scUNC import scUNC, evaluate_clustering
+
+    start = time.perf_counter()
+    set_seed(job["seed"])
+    if job["cache"]:
+        X, Y = loader.load_data(loader.ALL_data[job["dataset"]], cache=True, dtype=job["cache"])
+    else:
+        X, Y = loader.load_data(loader.ALL_data[job["dataset"]])
+    labels = Y[0].copy().astype(np.int32)
+    load_time = time.perf_counter() - start
+
+    model = scUNC(**job["params"])
+    fit_start = time.perf_counter()
+    cluster_labels, n_clusters = model.fit(X, Y)
+    fit_time = time.perf_counter() - fit_start
+
+    row = dict(job_id=job["job_id"], dataset=job["dataset"], seed=job["seed"], cache=job["cache"] or "",
+               params=json.dumps(job["params"], sort_keys=True), n_clusters=int(n_clusters),
+               load_time=round(load_time, 3), fit_time=round(fit_time, 3),
+               total_time=round(time.perf_counter() - start, 3))
+    row.update(evaluate_clustering(labels, cluster_labels))
+    return row
+
+
+def run_batch(jobs, results_path, n_workers, threads_per_job):
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    import multiprocessing
+
+    import load_data as loader
+    # Build the caches once here rather than racing in the workers
+    for dataset, dtype in {(job["dataset"], job["cache"]) for job in jobs if job["cache"]}:
+        loader.build_cache(loader.ALL_data[dataset], dtype)
+
+    finished = get_finished_jobs(results_path)
+    pending = [job for job in jobs if job["job_id"] not in finished]
+    print("{0} jobs, {1} already finished, {2} to run on {3} workers x {4} threads".format(
+        len(jobs), len(jobs) - len(pending), len(pending), n_workers, threads_per_job))
+
+    failed = 0
+    # spawn keeps the workers free of the parent's thread pools
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=init_worker, initargs=(threads_per_job,)) as pool:
+        futures = {pool.submit(run_job, job): job for job in pending}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                row = future.result()
+            except Exception as e:
+                failed += 1
+                print("[WARNING] Job {0} failed: {1!r}".format(job["job_id"], e))
+                continue
+            append_result(results_path, row)
+            print("{0}: K = {1}, ARI = {2}, NMI = {3}, ACC = {4}, PUR = {5} ({6}s)".format(
+                row["job_id"], row["n_clusters"], row["ari"], row["nmi"], row["acc"], row["pur"], row["total_time"]))
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='scUNC batch runner')
+    parser.add_argument('manifest', type=str)
+    parser.add_argument('--results', type=str, default="results.csv")
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--threads_per_job', type=int, default=None,
+                        help="defaults to the available cores divided by the number of workers")
+    args = parser.parse_args()
+
+    from parallel import available_cpus
+    threads_per_job = args.threads_per_job or max(1, available_cpus() // args.workers)
+    n_failed = run_batch(load_manifest(args.manifest), args.results, args.workers, threads_per_job)
+    if n_failed:
+        raise SystemExit("{0} jobs failed".format(n_failed))
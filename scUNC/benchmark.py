@@ -0,0 +1,170 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Import statement of each entry path and its cold-start budget in seconds
+IMPORT_TARGETS = dict(
+    inference=("import run_scUNC", 3.0),
+    evaluation=("from metrics import evaluate, evaluate_batch", 1.0),
+)
+
+
+def measure_import_time(statement, repeats=3):
+    """ Best wall-clock time of running `statement` in a fresh interpreter
+    """
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", statement], cwd=BENCH_DIR, check=True)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_import_time(repeats=3):
+    print("\n=== Import time ===")
+    passed = True
+    for name, (statement, target) in IMPORT_TARGETS.items():
+        elapsed = measure_import_time(statement, repeats)
+        ok = elapsed <= target
+        passed &= ok
+        print("{0:<12} {1:.3f}s (target {2:.1f}s) {3}".format(name, elapsed, target, "OK" if ok else "SLOW"))
+    return passed
+
+
+def bench_metrics(n_samples=1000000, n_preds=20, n_classes=20, seed=0):
+    import numpy as np
+    from metrics import evaluate, evaluate_batch
+
+    print("\n=== Metrics ({0} cells, {1} predictions) ===".format(n_samples, n_preds))
+    rng = np.random.RandomState(seed)
+    y_true = rng.randint(0, n_classes, n_samples)
+    y_preds = np.where(rng.rand(n_preds, n_samples) < 0.8, y_true, rng.randint(0, n_classes + 5, (n_preds, n_samples)))
+
+    start = time.perf_counter()
+    for y_pred in y_preds:
+        evaluate(y_true, y_pred)
+    single = time.perf_counter() - start
+    start = time.perf_counter()
+    evaluate_batch(y_true, y_preds)
+    batched = time.perf_counter() - start
+    print("evaluate x{0}: {1:.3f}s, evaluate_batch: {2:.3f}s".format(n_preds, single, batched))
+    return True
+
+
+def make_synthetic_data(n_samples=5000, n_clusters=10, dims=(2000, 2000), seed=0):
+    """Two views of Gaussian clusters scaled to [0, 1], shaped like the output of load_data"""
+    import numpy as np
+    import torch
+
+    rng = np.random.RandomState(seed)
+    y = rng.randint(0, n_clusters, n_samples)
+    X = []
+    for d in dims:
+        centers = rng.rand(n_clusters, d)
+        X.append(torch.from_numpy(np.clip(centers[y] + 0.1 * rng.randn(n_samples, d), 0, 1).astype(np.float32)))
+    return X, [y for _ in dims]
+
+
+def get_benchmark_data(dataset=None):
+    if dataset is None:
+        return make_synthetic_data()
+    import load_data as loader
+    return loader.load_data(loader.ALL_data[dataset])
+
+
+def fit_timed(X, Y, seed=0, **kwargs):
+    import numpy as np
+    import torch
+    from run_scUNC import scUNC, evaluate_clustering
+
+    params = dict(dip_merge_threshold=1, cluster_loss_weight=0.1, ae_loss_weight=100, batch_size=1024,
+                  learning_rate=1e-4, pretrain_epochs=20, dedc_epochs=5, embedding_size=100,
+                  n_clusters_max=np.inf, n_clusters_min=3, debug=False)
+    params.update(kwargs)
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    model = scUNC(**params)
+    start = time.perf_counter()
+    labels, n_clusters = model.fit(X, Y)
+    elapsed = time.perf_counter() - start
+    return model, elapsed, n_clusters, evaluate_clustering(Y[0], labels)
+
+
+def bench_accelerated(dataset=None, seed=0):
+    X, Y = get_benchmark_data(dataset)
+    n_samples = X[0].shape[0]
+    print("\n=== Eager float32 vs compiled bfloat16 ({0} cells) ===".format(n_samples))
+    for accelerated in (False, True):
+        model, elapsed, n_clusters, scores = fit_timed(X, Y, seed, accelerated=accelerated)
+        n_epochs = model.pretrain_epochs + model.dedc_epochs
+        print("{0:<12} {1:.1f}s ({2:.0f} cells/s), K = {3}, ARI = {4}, NMI = {5}".format(
+            "accelerated" if accelerated else "eager", elapsed, n_samples * n_epochs / elapsed, n_clusters,
+            scores['ari'], scores['nmi']))
+    return True
+
+
+def bench_reduction(dataset=None, seed=0, rank=256):
+    X, Y = get_benchmark_data(dataset)
+    print("\n=== Input reduction to rank {0} ({1} cells, views {2}) ===".format(
+        rank, X[0].shape[0], [view.shape[1] for view in X]))
+    baseline = None
+    for reduction in (None, 'svd', 'hvf'):
+        _, elapsed, n_clusters, scores = fit_timed(X, Y, seed, reduction=reduction, reduction_rank=rank)
+        baseline = baseline or elapsed
+        print("{0:<6} {1:.1f}s (x{2:.2f}), K = {3}, ARI = {4}, NMI = {5}".format(
+            reduction or "full", elapsed, baseline / elapsed, n_clusters, scores['ari'], scores['nmi']))
+    return True
+
+
+def bench_quantized(dataset=None, seed=0):
+    from utils import create_data_loader, detect_device, quantization_report
+    from datasets import TrainDataset
+
+    X, Y = get_benchmark_data(dataset)
+    print("\n=== int8 quantized bulk encoding ({0} cells) ===".format(X[0].shape[0]))
+    model, _, _, _ = fit_timed(X, Y, seed)
+    dataloader = create_data_loader(TrainDataset(X, Y), model.batch_size, init=True)
+    report = quantization_report(dataloader, model.autoencoder, detect_device(), model.cluster_centers_)
+    print("float32 {fp32_time:.2f}s, int8 {int8_time:.2f}s, drift {drift:.4f}, label agreement {agreement:.4f}".format(
+        **report))
+    return True
+
+
+def bench_reuse_embeddings(dataset=None, seed=0, refresh_every=5):
+    X, Y = get_benchmark_data(dataset)
+    print("\n=== Reused training-pass embeddings ({0} cells) ===".format(X[0].shape[0]))
+    for reuse, refresh in ((False, None), (True, None), (True, refresh_every)):
+        _, elapsed, n_clusters, scores = fit_timed(X, Y, seed, reuse_embeddings=reuse, embedding_refresh_every=refresh)
+        name = "re-encode" if not reuse else "reuse" if refresh is None else "reuse/{0}".format(refresh)
+        print("{0:<12} {1:.1f}s, K = {2}, ARI = {3}, NMI = {4}".format(
+            name, elapsed, n_clusters, scores['ari'], scores['nmi']))
+    return True
+
+
+BENCHMARKS = dict(
+    import_time=bench_import_time,
+    metrics=bench_metrics,
+    accelerated=bench_accelerated,
+    reduction=bench_reduction,
+    quantized=bench_quantized,
+    reuse_embeddings=bench_reuse_embeddings,
+)
+
+# Benchmarks that train the model and accept --dataset
+MODEL_BENCHMARKS = ("accelerated", "reduction", "quantized", "reuse_embeddings")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='scUNC benchmarks')
+    parser.add_argument('--only', nargs='*', default=list(BENCHMARKS), choices=list(BENCHMARKS))
+    parser.add_argument('--dataset', default=None, help="key of load_data.ALL_data; synthetic data if omitted")
+    args = parser.parse_args()
+    for name in args.only:
+        if name in MODEL_BENCHMARKS:
+            BENCHMARKS[name](dataset=args.dataset)
+        else:
+            BENCHMARKS[name]()
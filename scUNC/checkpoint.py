@@ -0,0 +1,97 @@
+import hashlib
+import json
+import os
+import random
+import time
+import numpy as np
+import torch
+
+
+def save_checkpoint(path, state):
+    """Write atomically, so a preempted job always leaves the previous or the new checkpoint behind"""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = "{0}.tmp{1}".format(path, os.getpid())
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path):
+    return torch.load(path, map_location="cpu", weights_only=False)
+
+
+def get_fingerprint(X, Y, params, n_rows=16):
+    """
+    Hash of the hyperparameters, the shapes and labels of the data and its first rows. A checkpoint is
+    only resumed by a run with the same fingerprint, so that its labels, centers and dips still belong
+    to the same cells in the same order.
+    """
+    sha = hashlib.sha256(json.dumps(params, sort_keys=True).encode())
+    for view in X:
+        sha.update(str(tuple(view.shape)).encode())
+        rows = view[:n_rows]
+        if isinstance(rows, torch.Tensor):
+            rows = rows.numpy()
+        sha.update(np.ascontiguousarray(rows, dtype=np.float32).tobytes())
+    sha.update(np.ascontiguousarray(Y[0], dtype=np.int64).tobytes())
+    return sha.hexdigest()
+
+
+def get_rng_state():
+    return dict(torch=torch.get_rng_state(), numpy=np.random.get_state(), python=random.getstate())
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state["torch"])
+    np.random.set_state(state["numpy"])
+    random.setstate(state["python"])
+
+
+class Checkpointer():
+    """
+    Periodic checkpoints of the clustering state of scUNC_training, every `every_epochs` epochs and/or
+    every `every_seconds` seconds of wall-clock time. Each checkpoint replaces the previous one, and the
+    last one is removed when the run finishes.
+    """
+
+    def __init__(self, path, every_epochs=None, every_seconds=None, fingerprint=None):
+        self.path = path
+        self.every_epochs = every_epochs
+        self.every_seconds = every_seconds
+        self.fingerprint = fingerprint
+        self.last_save = time.time()
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def remove(self):
+        if self.exists():
+            os.remove(self.path)
+
+    def is_due(self, epochs_done):
+        if self.every_epochs is not None and epochs_done % self.every_epochs == 0:
+            return True
+        return self.every_seconds is not None and time.time() - self.last_save >= self.every_seconds
+
+    def save(self, autoencoder, optimizer, epochs_done, i, n_clusters_current, centers_cpu, cluster_labels_cpu,
+             dip_matrix_cpu):
+        save_checkpoint(self.path, dict(
+            autoencoder=autoencoder.state_dict(),
+            optimizer=optimizer.state_dict(),
+            epochs_done=epochs_done,
+            i=i,
+            n_clusters_current=n_clusters_current,
+            centers_cpu=centers_cpu,
+            cluster_labels_cpu=cluster_labels_cpu,
+            dip_matrix_cpu=dip_matrix_cpu,
+            rng=get_rng_state(),
+            fingerprint=self.fingerprint,
+        ))
+        self.last_save = time.time()
+
+    def load(self):
+        state = load_checkpoint(self.path)
+        if state.get('fingerprint') != self.fingerprint:
+            raise ValueError("Checkpoint {0} was written by a run with other data or hyperparameters; remove it "
+                             "or use another checkpoint path".format(self.path))
+        return state
@@ -0,0 +1,139 @@
+"""
+Regression checks of properties the benchmarks rely on. Every check trains small models on synthetic
+data and prints OK or FAILED.
+
+    python checks.py [--only predict_single_sample ...]
+"""
+import argparse
+
+from benchmark import fit_timed, make_synthetic_data
+
+SMALL_PARAMS = dict(pretrain_epochs=3, dedc_epochs=4, batch_size=256, embedding_size=16)
+
+
+def report(name, ok, detail=""):
+    print("{0:<28} {1} {2}".format(name, "OK" if ok else "FAILED", detail))
+    return ok
+
+
+def check_predict_single_sample(seed=0):
+    """predict works on a single cell and on a trailing batch of one cell"""
+    import numpy as np
+
+    X, Y = make_synthetic_data(n_samples=1025, n_clusters=5, dims=(100, 80), seed=seed)
+    model, _, _, _ = fit_timed(X, Y, seed, **SMALL_PARAMS)
+    labels = model.predict(X)
+    single = model.predict([view[:1] for view in X])
+    ok = labels.shape == (1025,) and single.shape == (1,) and single[0] == labels[0]
+    return report("predict_single_sample", bool(ok), "labels {0}, single {1}".format(
+        np.bincount(labels).tolist(), single.tolist()))
+
+
+def check_resume(seed=0, preempt_after=2):
+    """
+    A run preempted after `preempt_after` checkpoints and resumed gives the labels of an uninterrupted
+    run, and a checkpoint is not resumed with other hyperparameters or with the cells reordered
+    """
+    import os
+    import tempfile
+    import numpy as np
+    import checkpoint
+
+    X, Y = make_synthetic_data(n_samples=1200, n_clusters=5, dims=(100, 80), seed=seed)
+    params = dict(SMALL_PARAMS, dip_merge_threshold=0.9)
+    expected, _, _, _ = fit_timed(X, Y, seed, **params)
+
+    class Preempted(Exception):
+        pass
+
+    save = checkpoint.Checkpointer.save
+    n_saves = [0]
+
+    def preempting_save(self, *args):
+        save(self, *args)
+        n_saves[0] += 1
+        if n_saves[0] == preempt_after:
+            raise Preempted()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "resume.pt")
+        checkpoint.Checkpointer.save = preempting_save
+        try:
+            fit_timed(X, Y, seed, checkpoint_path=path, checkpoint_every=1, **params)
+        except Preempted:
+            pass
+        finally:
+            checkpoint.Checkpointer.save = save
+
+        rejected = []
+        order = np.random.RandomState(seed).permutation(X[0].shape[0])
+        for name, data, other in (("params", (X, Y), dict(params, dip_merge_threshold=1e-4)),
+                                  ("order", ([view[order] for view in X], [y[order] for y in Y]), params)):
+            try:
+                fit_timed(*data, seed=seed, checkpoint_path=path, checkpoint_every=1, **other)
+            except ValueError:
+                rejected.append(name)
+
+        # Another seed, so the labels can only match through the restored RNG state
+        resumed, _, _, _ = fit_timed(X, Y, seed + 1, checkpoint_path=path, checkpoint_every=1, **params)
+        removed = not os.path.isfile(path)
+
+    same = bool(np.all(expected.labels_ == resumed.labels_))
+    return report("resume", same and removed and rejected == ["params", "order"],
+                  "same labels {0}, rejected {1}, removed when finished {2}".format(same, rejected, removed))
+
+
+def check_distributed(seed=0, world_sizes=(1, 2), min_ari=0.99):
+    """
+    Data-parallel runs give the labels of the single-process run: exactly with one rank, and up to
+    rounding of the summed gradients (ARI >= min_ari) with more
+    """
+    import numpy as np
+    from distributed import run_local
+    from metrics import evaluate
+
+    # An uneven last batch, and a last batch smaller than the number of ranks
+    X, Y = make_synthetic_data(n_samples=1025, n_clusters=5, dims=(100, 80), seed=seed)
+    params = dict(SMALL_PARAMS, dip_merge_threshold=0.9, cluster_loss_weight=0.1, n_clusters_min=3,
+                  learning_rate=1e-3)
+    expected, _, _, _ = fit_timed(X, Y, seed, ae_loss_weight=100, **params)
+
+    passed = True
+    for world_size in world_sizes:
+        labels, n_clusters = run_local(X, Y, world_size, seed=seed, ae_weight_loss=100, debug=False, **params)
+        ari = evaluate(expected.labels_, labels)['ari']
+        same = bool(np.all(expected.labels_ == labels))
+        ok = same if world_size == 1 else ari >= min_ari
+        passed &= report("distributed world_size={0}".format(world_size), ok,
+                         "K = {0} ({1}), same labels {2}, ARI {3:.4f}".format(n_clusters, expected.n_clusters_,
+                                                                             same, ari))
+    return passed
+
+
+def check_distributed_large_result(seed=0, n_samples=9000, world_size=2):
+    """run_local returns labels larger than the pipe buffer (64 KiB, about 8k int64 labels)"""
+    from distributed import run_local
+
+    X, Y = make_synthetic_data(n_samples=n_samples, n_clusters=5, dims=(20, 16), seed=seed)
+    params = dict(SMALL_PARAMS, pretrain_epochs=1, dedc_epochs=1, batch_size=1024)
+    labels, n_clusters = run_local(X, Y, world_size, seed=seed, dip_merge_threshold=0.9, cluster_loss_weight=0.1,
+                                   ae_weight_loss=100, n_clusters_min=3, learning_rate=1e-3, debug=False, **params)
+    return report("distributed_large_result", len(labels) == n_samples,
+                  "{0} labels, {1:.0f} KiB, K = {2}".format(len(labels), labels.nbytes / 1024, n_clusters))
+
+
+CHECKS = dict(
+    predict_single_sample=check_predict_single_sample,
+    resume=check_resume,
+    distributed=check_distributed,
+    distributed_large_result=check_distributed_large_result,
+)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='scUNC regression checks')
+    parser.add_argument('--only', nargs='*', default=list(CHECKS), choices=list(CHECKS))
+    args = parser.parse_args()
+    passed = all([CHECKS[name]() for name in args.only])
+    if not passed:
+        raise SystemExit("Some checks failed")
@@ -12,7 +12,8 @@ class TrainDataset(torch.utils.data.Dataset):
         current_x_list = []
         current_y_list = []
         for v in range(self.view_size):
-            current_x = self.X_list[v][index]
+            # float() also upcasts views cached in float16
+            current_x = self.X_list[v][index].float()
             current_x_list.append(current_x)
             current_y = self.Y_list[v][index]
             current_y_list.append(current_y)
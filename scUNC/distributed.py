@@ -0,0 +1,317 @@
+"""
+Data-parallel scUNC on CPU with torch.distributed (gloo).
+
+Every global mini-batch of `batch_size` samples is split evenly across the ranks. Each rank runs the
+per-view encoders and the decoder on its rows only; the encoder outputs are all-gathered, so the
+transformer layer, which attends across all samples of a batch, and the dropout masks see the whole
+global batch exactly as in the single-process run. Each rank back-propagates its loss weighted by its
+share of the batch, and the gradients are summed over the ranks before the optimizer step. Rank 0 owns
+the Louvain initialization and the center, dip and merge updates and broadcasts their result together
+with its RNG state, so all ranks draw the same random numbers as run_scUNC._scUNC.
+
+In float32 eager mode world_size=1 reproduces _scUNC bit for bit. With more ranks, the gradients are
+summed in another order and can differ in the last bits, which can change the labels of a few cells
+after many epochs. With --accelerated, torch.compile draws the dropout masks itself, so the run is
+not comparable to the eager one.
+
+Local:      python distributed.py --dataset SMAGE3K --world_size 4
+Multi-node: torchrun --nnodes 2 --nproc_per_node 4 ... distributed.py --dataset SMAGE3K
+"""
+import argparse
+import os
+import numpy as np
+import torch
+import torch.distributed as dist
+from checkpoint import get_rng_state, set_rng_state
+from datasets import TrainDataset
+from model import Network, bf16_autocast, get_encode_decode
+from parallel import available_cpus, configure_threads
+from run_scUNC import get_cluster_loss, get_epoch_tensors, merge_clusters, print_iteration, update_centers
+from utils import create_data_loader, detect_device, get_center_labels, get_dip_matrix, \
+    get_nearest_points_to_optimal_centers, judge_system
+
+
+def init_process_group(rank=None, world_size=None, master_addr="127.0.0.1", master_port=29500):
+    """Join the gloo process group. Without rank/world_size the torchrun environment is used."""
+    if rank is None:
+        dist.init_process_group("gloo")
+    else:
+        os.environ.setdefault("MASTER_ADDR", master_addr)
+        os.environ.setdefault("MASTER_PORT", str(master_port))
+        dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    return dist.get_rank(), dist.get_world_size()
+
+
+def get_shard(n_rows, rank, world_size):
+    """Rows of a global batch that belong to this rank, and the number of rows of every rank"""
+    counts = [len(part) for part in np.array_split(np.arange(n_rows), world_size)]
+    start = sum(counts[:rank])
+    return slice(start, start + counts[rank]), counts
+
+
+class GatherRows(torch.autograd.Function):
+    """
+    Concatenate the rows of all ranks (in rank order) on every rank. The backward sums the gradients of
+    the full batch over the ranks and returns the rows of this rank, so gradients of every rank's loss
+    reach the encoders of the rank that computed the rows. Uses all_gather and all_reduce only, which
+    gloo supports, and allows an uneven number of rows per rank.
+    """
+
+    @staticmethod
+    def forward(ctx, local, counts):
+        ctx.rows = get_shard(sum(counts), dist.get_rank(), len(counts))[0]
+        padded = local.new_zeros((max(counts),) + local.shape[1:])
+        padded[:local.shape[0]] = local
+        gathered = [torch.empty_like(padded) for _ in counts]
+        dist.all_gather(gathered, padded.contiguous())
+        return torch.cat([part[:count] for part, count in zip(gathered, counts)], dim=0)
+
+    @staticmethod
+    def backward(ctx, grad):
+        grad = grad.contiguous().clone()
+        dist.all_reduce(grad, op=dist.ReduceOp.SUM)
+        return grad[ctx.rows], None
+
+
+def get_sharded_modules(model, compile=False):
+    """encode_views, extract_layers and decode of the model, compiled with torch.compile if requested"""
+    if compile:
+        return torch.compile(model.encode_views, dynamic=True), torch.compile(model.extract_layers, dynamic=True), \
+            torch.compile(model.decode, dynamic=True)
+    return model.encode_views, model.extract_layers, model.decode
+
+
+def iterate_sharded_batches(dataloader, rank, world_size):
+    """
+    This rank's rows of every global mini-batch of the data loader. Iterating the same data loader as
+    the single-process run also consumes the same random numbers.
+    """
+    for batch, ids in dataloader:
+        rows, counts = get_shard(batch[0].shape[0], rank, world_size)
+        yield [torch.flatten(x[rows], start_dim=1) for x in batch], [y[rows] for y in ids], rows, counts
+
+
+def sharded_forward(modules, xs, rows, counts, device):
+    """Embeddings of the whole global batch on every rank, and the reconstruction of this rank's rows"""
+    encode_views, extract_layers, decode = modules
+    embedded = extract_layers(GatherRows.apply(encode_views([x.to(device) for x in xs]), counts))
+    out1, out2 = decode(embedded, rows)
+    return embedded, out1, out2
+
+
+def all_reduce_gradients(model):
+    """Sum the gradients over all ranks"""
+    for p in model.parameters():
+        if p.grad is None:
+            p.grad = torch.zeros_like(p)
+        dist.all_reduce(p.grad, op=dist.ReduceOp.SUM)
+
+
+def weighted_backward(loss, embedded, weight):
+    # Ranks without rows in this batch still take part in the all_reduce in the backward of GatherRows
+    (loss * weight if weight > 0 else embedded.sum() * 0).backward()
+
+
+def broadcast_state(state, rank):
+    """Broadcast a picklable object and the RNG state from rank 0"""
+    objects = [(state, get_rng_state()) if rank == 0 else None]
+    dist.broadcast_object_list(objects, src=0)
+    state, rng = objects[0]
+    set_rng_state(rng)
+    return state
+
+
+def encode_distributed(dataloader, model, rank, world_size, device, accelerated=False):
+    """Embed the whole data set with the rows of every batch split over the ranks. Returned on every rank."""
+    encode_views, extract_layers, _ = get_sharded_modules(model, compile=accelerated)
+    embeddings = []
+    with torch.no_grad():
+        for xs, _, _, counts in iterate_sharded_batches(dataloader, rank, world_size):
+            with bf16_autocast(device, enabled=accelerated):
+                embedded = extract_layers(GatherRows.apply(encode_views([x.to(device) for x in xs]), counts))
+            embeddings.append(embedded.float().cpu())
+    return torch.cat(embeddings, dim=0).numpy()
+
+
+def pretrain_distributed(dataloader, model, optimizer, loss_fn, n_epochs, rank, world_size, device,
+                         accelerated=False):
+    modules = get_sharded_modules(model, compile=accelerated)
+    for _ in range(n_epochs):
+        for xs, _, rows, counts in iterate_sharded_batches(dataloader, rank, world_size):
+            xs = [x.to(device) for x in xs]
+            with bf16_autocast(device, enabled=accelerated):
+                embedded, out1, out2 = sharded_forward(modules, xs, rows, counts, device)
+                loss = loss_fn(out1, xs[0]) + loss_fn(out2, xs[1])
+            optimizer.zero_grad()
+            weighted_backward(loss, embedded, counts[rank] / sum(counts))
+            all_reduce_gradients(model)
+            optimizer.step()
+
+
+def scUNC_distributed(X, Y, rank, world_size, dip_merge_threshold, cluster_loss_weight, ae_weight_loss,
+                      n_clusters_min, batch_size, learning_rate, pretrain_epochs, dedc_epochs, embedding_size, debug,
+                      accelerated=False, loss_fn=torch.nn.MSELoss()):
+    """Data-parallel counterpart of run_scUNC._scUNC. Labels are returned on every rank."""
+    device = detect_device()
+    dataloader = create_data_loader(TrainDataset(X, Y), batch_size, init=True)
+    act_fn = torch.nn.ReLU if judge_system() else torch.nn.LeakyReLU
+    autoencoder = Network(input_A=X[0].shape[1], input_B=X[1].shape[1], embedding_size=embedding_size,
+                          act_fn=act_fn).to(device)
+    # Start all ranks from the weights of rank 0
+    for p in autoencoder.parameters():
+        dist.broadcast(p.data, src=0)
+
+    optimizer = torch.optim.Adam(autoencoder.parameters(), lr=learning_rate)
+    pretrain_distributed(dataloader, autoencoder, optimizer, loss_fn, pretrain_epochs, rank, world_size, device,
+                         accelerated)
+
+    embedded_data = encode_distributed(dataloader, autoencoder, rank, world_size, device, accelerated)
+    state = None
+    if rank == 0:
+        init_centers, cluster_labels_cpu = get_center_labels(embedded_data, resolution=3.0)
+        n_clusters_current = len(np.unique(cluster_labels_cpu))
+        print("\n "  "Initialize " + str(n_clusters_current) + "  mirco_clusters \n")
+        centers_cpu, embedded_centers_cpu = get_nearest_points_to_optimal_centers(X, init_centers, embedded_data)
+        dip_matrix_cpu = get_dip_matrix(embedded_data, embedded_centers_cpu, cluster_labels_cpu, n_clusters_current)
+        state = (0, n_clusters_current, centers_cpu, cluster_labels_cpu, dip_matrix_cpu)
+    i, n_clusters_current, centers_cpu, cluster_labels_cpu, dip_matrix_cpu = broadcast_state(state, rank)
+
+    optimizer = torch.optim.Adam(autoencoder.parameters(), lr=learning_rate * 0.1)
+    encode, _ = get_encode_decode(autoencoder, compile=accelerated)
+    modules = get_sharded_modules(autoencoder, compile=accelerated)
+    while i < dedc_epochs:
+        centers_torch, cluster_labels_torch, dip_matrix_final = get_epoch_tensors(centers_cpu, cluster_labels_cpu,
+                                                                                  dip_matrix_cpu, n_clusters_current,
+                                                                                  device)
+        for xs, ids, rows, counts in iterate_sharded_batches(dataloader, rank, world_size):
+            xs = [x.to(device) for x in xs]
+            # Same order of random draws as run_scUNC.get_scUNC_loss
+            with bf16_autocast(device, enabled=accelerated):
+                embedded, out1, out2 = sharded_forward(modules, xs, rows, counts, device)
+                embedded_centers_torch = encode(centers_torch)
+                ae_loss = loss_fn(out1, xs[0]) + loss_fn(out2, xs[1])
+            ae_loss, cluster_loss, loss, _ = get_cluster_loss(ae_loss, embedded[rows], embedded_centers_torch, ids,
+                                                              cluster_labels_torch, dip_matrix_final,
+                                                              n_clusters_current, i, cluster_loss_weight,
+                                                              ae_weight_loss)
+            optimizer.zero_grad()
+            weighted_backward(loss, embedded, counts[rank] / sum(counts))
+            all_reduce_gradients(autoencoder)
+            optimizer.step()
+
+        embedded_data = encode_distributed(dataloader, autoencoder, rank, world_size, device, accelerated)
+        state = None
+        if rank == 0:
+            cluster_labels_cpu, centers_cpu, embedded_centers_cpu, dip_matrix_cpu = \
+                update_centers(X, embedded_data, encode, centers_torch, n_clusters_current, device, accelerated)
+            if debug:
+                print_iteration(i, n_clusters_current, ae_loss, cluster_loss, loss, dip_matrix_cpu)
+            i, n_clusters_current, cluster_labels_cpu, centers_cpu, dip_matrix_cpu = \
+                merge_clusters(X, embedded_data, i + 1, n_clusters_current, cluster_labels_cpu, centers_cpu,
+                               embedded_centers_cpu, dip_matrix_cpu, dip_merge_threshold, n_clusters_min, debug)
+            state = (i, n_clusters_current, centers_cpu, cluster_labels_cpu, dip_matrix_cpu)
+        i, n_clusters_current, centers_cpu, cluster_labels_cpu, dip_matrix_cpu = broadcast_state(state, rank)
+
+        if n_clusters_current == 1:
+            if debug and rank == 0:
+                print("Only one cluster left")
+            break
+
+    return cluster_labels_cpu, n_clusters_current, centers_cpu, autoencoder
+
+
+def _local_worker(rank, world_size, X, Y, params, threads_per_worker, master_port, results):
+    configure_threads(torch_threads=threads_per_worker, blas_threads=threads_per_worker)
+    init_process_group(rank, world_size, master_port=master_port)
+    seed = params.pop("seed", 0)
+    # Seeded like benchmark.fit_timed, so the run is comparable to run_scUNC.scUNC.fit
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    try:
+        labels, n_clusters, _, _ = scUNC_distributed(X, Y, rank, world_size, **params)
+        if rank == 0:
+            results.put((labels, n_clusters))
+    finally:
+        dist.destroy_process_group()
+
+
+def run_local(X, Y, world_size, threads_per_worker=None, master_port=29500, **params):
+    """
+    Run scUNC_distributed on `world_size` local processes.
+
+    :param params: keyword arguments of scUNC_distributed, plus an optional 'seed'
+    :return: labels and estimated number of clusters
+    """
+    import torch.multiprocessing as mp
+
+    if threads_per_worker is None:
+        threads_per_worker = max(1, available_cpus() // world_size)
+    results = mp.get_context("spawn").SimpleQueue()
+    context = mp.spawn(_local_worker, args=(world_size, X, Y, params, threads_per_worker, master_port, results),
+                       nprocs=world_size, join=False)
+    # Read the result while the workers run: rank 0 blocks in put until the labels are read, once they
+    # exceed the pipe buffer. join raises if a worker failed, so a missing result cannot hang here.
+    result = None
+    while result is None:
+        if not results.empty():
+            result = results.get()
+        elif context.join(timeout=1):
+            result = results.get()
+    while not context.join():
+        pass
+    return result
+
+
+if __name__ == "__main__":
+    import load_data as loader
+    from run_scUNC import evaluate_clustering
+
+    parser = argparse.ArgumentParser(description='data-parallel scUNC')
+    parser.add_argument('--dataset', default='SMAGE3K', choices=list(loader.ALL_data))
+    parser.add_argument('--world_size', type=int, default=None,
+                        help="number of local processes; omit when launched by torchrun")
+    parser.add_argument('--threads_per_worker', type=int, default=None)
+    parser.add_argument('--master_port', type=int, default=29500)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--dip_merge_threshold', type=float, default=1)
+    parser.add_argument('--cluster_loss_weight', type=float, default=0.1)
+    parser.add_argument('--ae_loss_weight', type=float, default=100)
+    parser.add_argument('--n_clusters_min', type=int, default=3)
+    parser.add_argument('--batch_size', type=int, default=1024)
+    parser.add_argument('--learning_rate', type=float, default=1e-4)
+    parser.add_argument('--pretrain_epochs', type=int, default=100)
+    parser.add_argument('--dedc_epochs', type=int, default=50)
+    parser.add_argument('--embedding_size', type=int, default=100)
+    parser.add_argument('--debug', action='store_true')
+    parser.add_argument('--accelerated', action='store_true')
+    args = parser.parse_args()
+
+    # Every rank has to load the same permutation of the data
+    np.random.seed(args.seed)
+    X, Y = loader.load_data(loader.ALL_data[args.dataset])
+    params = dict(dip_merge_threshold=args.dip_merge_threshold, cluster_loss_weight=args.cluster_loss_weight,
+                  ae_weight_loss=args.ae_loss_weight, n_clusters_min=args.n_clusters_min,
+                  batch_size=args.batch_size, learning_rate=args.learning_rate,
+                  pretrain_epochs=args.pretrain_epochs, dedc_epochs=args.dedc_epochs,
+                  embedding_size=args.embedding_size, debug=args.debug, accelerated=args.accelerated)
+
+    if args.world_size is not None:
+        cluster_labels, n_clusters = run_local(X, Y, args.world_size, args.threads_per_worker, args.master_port,
+                                               seed=args.seed, **params)
+        rank = 0
+    else:
+        if args.threads_per_worker is not None:
+            configure_threads(torch_threads=args.threads_per_worker, blas_threads=args.threads_per_worker)
+        rank, world_size = init_process_group()
+        torch.manual_seed(args.seed)
+        np.random.seed(args.seed)
+        cluster_labels, n_clusters, _, _ = scUNC_distributed(X, Y, rank, world_size, **params)
+        dist.destroy_process_group()
+
+    if rank == 0:
+        scores = evaluate_clustering(Y[0].copy().astype(np.int32), cluster_labels)
+        print("The estimated number of clusters:", n_clusters)
+        print("ARI: ", scores['ari'])
+        print("NMI:", scores['nmi'])
+        print("ACC: ", scores['acc'])
+        print("PUR: ", scores['pur'])
@@ -1,7 +1,8 @@
 import numpy as np
 import torch
-from sklearn.preprocessing import MinMaxScaler
-import h5py
+import os
+import json
+import hashlib
 import warnings
 warnings.filterwarnings("ignore")
 
@@ -12,11 +13,15 @@ ALL_data = dict(
     )
 
 path = './data/'
+cache_path = './data/cache/'
+
+def read_views(dataset):
+    import h5py
+    from sklearn.preprocessing import MinMaxScaler
 
-def load_data(dataset):
     data = h5py.File(path + dataset[1] + ".mat")
     X = []
-    Y = []
+    scalers = []
     Label = np.array(data['Y']).T
     Label = Label.reshape(Label.shape[0])
     mm = MinMaxScaler()
@@ -25,7 +30,15 @@ def load_data(dataset):
         diff_view = np.array(diff_view, dtype=np.float32).T
         std_view = mm.fit_transform(diff_view)
         X.append(std_view)
-        Y.append(Label)
+        scalers.append(dict(data_min=mm.data_min_, data_max=mm.data_max_, scale=mm.scale_, min=mm.min_))
+    return X, Label, scalers
+
+def load_data(dataset, cache=False, dtype='float32'):
+    if cache:
+        return load_cached_data(dataset, dtype)
+
+    X, Label, _ = read_views(dataset)
+    Y = [Label for _ in X]
     size = len(Y[0])
     view_num = len(X)
     index = [i for i in range(size)]
@@ -38,6 +51,89 @@ def load_data(dataset):
 
     return X, Y
 
+def get_source_hash(source):
+    """sha256 of the source file, remembered next to the cache as long as size and mtime do not change"""
+    stat = os.stat(source)
+    record_file = os.path.join(cache_path, os.path.basename(source) + ".hash.json")
+    record = None
+    if os.path.isfile(record_file):
+        try:
+            with open(record_file) as f:
+                record = json.load(f)
+        except json.JSONDecodeError:
+            # A truncated record, e.g. from an interrupted write; hash the file again
+            record = None
+    if record is not None and record['size'] == stat.st_size and record['mtime_ns'] == stat.st_mtime_ns:
+        return record['sha256']
+    sha = hashlib.sha256()
+    with open(source, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    os.makedirs(cache_path, exist_ok=True)
+    # Write and rename, so that concurrent jobs never read a partly written record
+    tmp_file = "{0}.tmp{1}".format(record_file, os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump(dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns, sha256=sha.hexdigest()), f)
+    os.replace(tmp_file, record_file)
+    return sha.hexdigest()
+
+def get_cache_dir(dataset, dtype='float32'):
+    source = path + dataset[1] + ".mat"
+    return os.path.join(cache_path, "{0}-{1}-{2}".format(dataset[1], get_source_hash(source)[:16], dtype))
+
+def build_cache(dataset, dtype='float32', seed=0):
+    """
+    Convert a dataset once into .npy files that load_cached_data memory-maps: the scaled views in
+    float32 (or float16), the labels, the MinMaxScaler parameters of every view and the permutation
+    of the cells. The cells are shuffled once here, with a fixed seed, instead of on every load.
+    """
+    cache_dir = get_cache_dir(dataset, dtype)
+    if os.path.isdir(cache_dir):
+        return cache_dir
+
+    X, Label, scalers = read_views(dataset)
+    index = np.random.RandomState(seed).permutation(len(Label))
+    tmp_dir = "{0}.tmp{1}".format(cache_dir, os.getpid())
+    os.makedirs(tmp_dir, exist_ok=True)
+    for v in range(len(X)):
+        np.save(os.path.join(tmp_dir, "view{0}.npy".format(v)), X[v][index].astype(dtype))
+        np.savez(os.path.join(tmp_dir, "scaler{0}.npz".format(v)), **scalers[v])
+    np.save(os.path.join(tmp_dir, "labels.npy"), Label[index])
+    np.save(os.path.join(tmp_dir, "index.npy"), index)
+    with open(os.path.join(tmp_dir, "meta.json"), 'w') as f:
+        json.dump(dict(name=dataset[1], n_views=len(X), n_samples=len(Label), dtype=dtype, seed=seed), f)
+    try:
+        # Atomic, so concurrent jobs never see a half written cache
+        os.rename(tmp_dir, cache_dir)
+    except OSError:
+        import shutil
+        shutil.rmtree(tmp_dir)
+    return cache_dir
+
+def load_cached_data(dataset, dtype='float32'):
+    """
+    Same output as load_data, but the views are read-only memory maps of the cache wrapped without a copy
+    by torch.from_numpy, so concurrent jobs on one host share the page cache. Builds the cache if needed.
+    """
+    cache_dir = build_cache(dataset, dtype)
+    with open(os.path.join(cache_dir, "meta.json")) as f:
+        meta = json.load(f)
+    X = []
+    Y = []
+    Label = np.load(os.path.join(cache_dir, "labels.npy"))
+    for v in range(meta['n_views']):
+        view = np.load(os.path.join(cache_dir, "view{0}.npy".format(v)), mmap_mode='r')
+        X.append(torch.from_numpy(view))
+        Y.append(Label)
+    return X, Y
+
+def load_scalers(dataset, dtype='float32'):
+    """MinMaxScaler parameters of every view stored in the cache"""
+    cache_dir = get_cache_dir(dataset, dtype)
+    with open(os.path.join(cache_dir, "meta.json")) as f:
+        meta = json.load(f)
+    return [dict(np.load(os.path.join(cache_dir, "scaler{0}.npz".format(v)))) for v in range(meta['n_views'])]
+
 
 
 
@@ -0,0 +1,102 @@
+"""
+Clustering metrics derived from one contingency table built with np.bincount.
+Inputs are never modified. Only numpy is needed at import time.
+"""
+import numpy as np
+
+
+def _encode(labels):
+    """Map arbitrary labels to 0..K-1"""
+    _, codes = np.unique(np.asarray(labels).ravel(), return_inverse=True)
+    return codes.astype(np.int64), codes.max() + 1 if codes.size else 0
+
+
+def contingency_matrix(y_true, y_pred):
+    """Contingency table of shape (n_true_classes, n_pred_clusters)"""
+    true_codes, n_true = _encode(y_true)
+    pred_codes, n_pred = _encode(y_pred)
+    assert true_codes.size == pred_codes.size
+    return np.bincount(true_codes * n_pred + pred_codes, minlength=n_true * n_pred).reshape(n_true, n_pred)
+
+
+def batch_contingency_matrices(y_true, y_preds):
+    """
+    Contingency tables of many predictions against one ground truth, shape (n_preds, n_true, n_max_pred).
+    All tables come from a single bincount.
+    """
+    true_codes, n_true = _encode(y_true)
+    encoded = [_encode(y_pred) for y_pred in y_preds]
+    n_pred = max(n for _, n in encoded)
+    index = np.concatenate([b * n_true * n_pred + true_codes * n_pred + codes for b, (codes, _) in enumerate(encoded)])
+    size = len(encoded) * n_true * n_pred
+    return np.bincount(index, minlength=size).reshape(len(encoded), n_true, n_pred)
+
+
+def _comb2(x):
+    return x * (x - 1) / 2.
+
+
+def accuracy_from_contingency(c):
+    from scipy.optimize import linear_sum_assignment
+    rows, cols = linear_sum_assignment(-c)
+    return c[rows, cols].sum() / c.sum()
+
+
+def purity_from_contingency(c):
+    return c.max(axis=0).sum() / c.sum()
+
+
+def ari_from_contingency(c):
+    n = c.sum()
+    if n < 2:
+        # No pairs to compare, as sklearn
+        return 1.0
+    sum_comb = _comb2(c.astype(np.float64)).sum()
+    sum_comb_true = _comb2(c.sum(axis=1).astype(np.float64)).sum()
+    sum_comb_pred = _comb2(c.sum(axis=0).astype(np.float64)).sum()
+    expected = sum_comb_true * sum_comb_pred / _comb2(float(n))
+    max_index = (sum_comb_true + sum_comb_pred) / 2.
+    if max_index == expected:
+        # Both labelings are a single cluster or all singletons
+        return 1.0
+    return (sum_comb - expected) / (max_index - expected)
+
+
+def _entropy(counts, n):
+    p = counts[counts > 0] / n
+    return -np.sum(p * np.log(p))
+
+
+def nmi_from_contingency(c):
+    """NMI with arithmetic mean normalization, as sklearn's default"""
+    n = c.sum()
+    a = c.sum(axis=1)
+    b = c.sum(axis=0)
+    if np.count_nonzero(a) == np.count_nonzero(b) == 1:
+        return 1.0
+    i, j = np.nonzero(c)
+    nij = c[i, j].astype(np.float64)
+    mi = np.sum(nij / n * (np.log(nij * n) - np.log(a[i].astype(np.float64) * b[j])))
+    normalizer = max((_entropy(a, n) + _entropy(b, n)) / 2., np.finfo(np.float64).eps)
+    return max(mi, 0.) / normalizer
+
+
+def evaluate(y_true, y_pred):
+    """ACC (Hungarian), purity, ARI and NMI of one prediction"""
+    c = contingency_matrix(y_true, y_pred)
+    return dict(ari=float(ari_from_contingency(c)), nmi=float(nmi_from_contingency(c)),
+                acc=float(accuracy_from_contingency(c)), pur=float(purity_from_contingency(c)))
+
+
+def evaluate_batch(y_true, y_preds):
+    """
+    Evaluate many predicted label vectors against one ground truth.
+
+    :param y_preds: 2d array of shape (n_preds, n_samples) or a list of label vectors
+    :return: dict mapping 'ari', 'nmi', 'acc' and 'pur' to arrays of length n_preds
+    """
+    tables = batch_contingency_matrices(y_true, y_preds)
+    return dict(ari=np.array([ari_from_contingency(c) for c in tables]),
+                nmi=np.array([nmi_from_contingency(c) for c in tables]),
+                acc=np.array([accuracy_from_contingency(c) for c in tables]),
+                pur=np.array([purity_from_contingency(c) for c in tables]))
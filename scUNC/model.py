@@ -1,7 +1,46 @@
+import contextlib
+import copy
+import weakref
 import torch
 from torch import nn
 from torch.nn import functional as F
 
+# model -> (weights version, int8 copy), see get_quantized_encode
+_QUANTIZED_COPIES = weakref.WeakKeyDictionary()
+
+
+def get_encode_decode(model, compile=False):
+    """encode/decode of the model, compiled with torch.compile if requested"""
+    if compile:
+        return torch.compile(model.encode, dynamic=True), torch.compile(model.decode, dynamic=True)
+    return model.encode, model.decode
+
+
+def get_quantized_encode(model):
+    """
+    encode of a dynamically int8 quantized copy of the model, for forward-only passes on CPU.
+    The copy is rebuilt whenever the weights changed since it was made (every in-place update,
+    e.g. an optimizer step, bumps the version counter of a parameter).
+    """
+    version = tuple(p._version for p in model.parameters())
+    cached = _QUANTIZED_COPIES.get(model)
+    if cached is None or cached[0] != version:
+        quantized = torch.ao.quantization.quantize_dynamic(copy.deepcopy(model).cpu(), {nn.Linear},
+                                                           dtype=torch.qint8)
+        cached = (version, quantized)
+        _QUANTIZED_COPIES[model] = cached
+    # Follow the train/eval mode of the model (dropout)
+    cached[1].train(model.training)
+    return cached[1].encode
+
+
+def bf16_autocast(device, enabled=True):
+    """bfloat16 autocast for the forward pass; parameters and optimizer state stay in float32"""
+    if not enabled:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16)
+
+
 class Network(nn.Module):
     def __init__(self, input_A: int,input_B: int, embedding_size: int, act_fn=torch.nn.LeakyReLU):
         super(Network, self).__init__()
@@ -31,17 +70,25 @@ class Network(nn.Module):
         self.layer6_1 = nn.Linear(500, input_A)
         self.layer6_2 = nn.Linear(300, input_B)
         self.drop = 0.5
-    def encode(self, Xs: torch.Tensor) -> torch.Tensor:
-
+    def encode_views(self, Xs: torch.Tensor) -> torch.Tensor:
+        """Per-view encoders. The rows are independent here, unlike in extract_layers, which attends
+        across all samples of the batch."""
         x1, x2 = Xs
         x1 = self.encoder1(x1)
         x2 = self.encoder2(x2)
-        y = self.extract_layers(torch.cat((x1, x2), 1))
+        return torch.cat((x1, x2), 1)
+
+    def encode(self, Xs: torch.Tensor) -> torch.Tensor:
+
+        y = self.extract_layers(self.encode_views(Xs))
         
         return y
 
-    def decode(self, embedded) :
+    def decode(self, embedded, rows=None) :
         x = F.dropout(F.relu(self.layer4(embedded)), self.drop)
+        if rows is not None:
+            # Only decode these rows; the dropout mask is still drawn for the whole batch (data parallel)
+            x = x[rows]
         out1 = F.relu(self.layer5_1(x))
         out1 = self.layer6_1(out1)
         out2 = self.layer6_2(x)
@@ -52,14 +99,16 @@ class Network(nn.Module):
         out1,out2 = self.decode(embedded)
         return out1,out2
 
-    def start_training(self, trainloader, n_epochs, device, optimizer, loss_fn):
+    def start_training(self, trainloader, n_epochs, device, optimizer, loss_fn, accelerated=False):
+        encode, decode = get_encode_decode(self, compile=accelerated)
         for _ in range(n_epochs):
             for batch_idx, (xs, _) in enumerate(trainloader):
                 for v in range(2):
-                    xs[v] = torch.squeeze(xs[v]).to(device)
-                emb = self.encode(xs)
-                out1, out2 = self.decode(emb)
-                loss = loss_fn(out1, xs[0])+loss_fn(out2, xs[1])
+                    xs[v] = torch.flatten(xs[v], start_dim=1).to(device)
+                with bf16_autocast(device, enabled=accelerated):
+                    emb = encode(xs)
+                    out1, out2 = decode(emb)
+                    loss = loss_fn(out1, xs[0])+loss_fn(out2, xs[1])
                 optimizer.zero_grad()
                 loss.backward()
                 optimizer.step()
@@ -0,0 +1,116 @@
+import os
+# torch is imported inside the functions, so the BLAS environment can be set before it is loaded
+
+BLAS_ENV_VARS = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "NUMEXPR_NUM_THREADS",
+                 "VECLIB_MAXIMUM_THREADS")
+
+# Number of threads used to evaluate dip tests of cluster pairs in parallel
+DIP_WORKERS = 1
+
+
+def available_cpus():
+    """Number of cores this process is allowed to run on"""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def blas_thread_env(n_threads):
+    """Environment variables capping the BLAS/OpenMP pools of a process started with them"""
+    return {name: str(n_threads) for name in BLAS_ENV_VARS}
+
+
+def set_blas_threads(n_threads):
+    """
+    Limit the BLAS pools used by numpy/scipy (cdist, np.dot). Uses threadpoolctl when it is
+    installed; otherwise only the environment is updated, which affects libraries loaded afterwards.
+    The OpenMP runtime is left alone, since torch shares it and sets its size with torch_threads.
+    """
+    os.environ.update(blas_thread_env(n_threads))
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    threadpool_limits(limits=n_threads, user_api="blas")
+
+
+def get_blas_threads():
+    try:
+        from threadpoolctl import threadpool_info
+    except ImportError:
+        value = os.environ.get("OMP_NUM_THREADS")
+        return int(value) if value else None
+    pools = [pool["num_threads"] for pool in threadpool_info() if pool["user_api"] == "blas"]
+    return max(pools) if pools else None
+
+
+def configure_threads(torch_threads=None, torch_interop_threads=None, blas_threads=None, dip_workers=None,
+                      cpu_affinity=None):
+    """
+    Set thread counts per subsystem and, optionally, pin the process to a set of cores.
+    Arguments left as None keep their current value.
+
+    :param torch_threads: intra-op threads of torch
+    :param torch_interop_threads: inter-op threads of torch (can only be set once per process)
+    :param blas_threads: threads of the BLAS pools behind numpy and scipy
+    :param dip_workers: threads evaluating dip tests in get_dip_matrix
+    :param cpu_affinity: iterable of core ids the process may run on
+    :return: dict with the effective settings
+    """
+    import torch
+    global DIP_WORKERS
+
+    if cpu_affinity is not None:
+        if not hasattr(os, "sched_setaffinity"):
+            print("[WARNING] CPU affinity is not supported on this platform and is ignored.")
+        else:
+            os.sched_setaffinity(0, set(cpu_affinity))
+    if blas_threads is not None:
+        set_blas_threads(blas_threads)
+    # After the BLAS limits, so that torch_threads is what torch ends up with
+    if torch_threads is not None:
+        torch.set_num_threads(torch_threads)
+    if torch_interop_threads is not None:
+        try:
+            torch.set_num_interop_threads(torch_interop_threads)
+        except RuntimeError:
+            print("[WARNING] torch inter-op threads were already initialized and are left unchanged.")
+    if dip_workers is not None:
+        DIP_WORKERS = max(1, int(dip_workers))
+    return get_thread_settings()
+
+
+def get_thread_settings():
+    import torch
+    settings = dict(
+        cpus=available_cpus(),
+        torch_threads=torch.get_num_threads(),
+        torch_interop_threads=torch.get_num_interop_threads(),
+        blas_threads=get_blas_threads(),
+        dip_workers=DIP_WORKERS,
+    )
+    if hasattr(os, "sched_getaffinity"):
+        settings["cpu_affinity"] = sorted(os.sched_getaffinity(0))
+    return settings
+
+
+def format_thread_settings(settings):
+    affinity = settings.get("cpu_affinity")
+    if affinity is not None:
+        affinity = "{0}-{1}".format(affinity[0], affinity[-1]) if affinity == list(
+            range(affinity[0], affinity[-1] + 1)) else ",".join(map(str, affinity))
+    return "Threads - cpus: {0}, torch: {1}, torch inter-op: {2}, blas: {3}, dip workers: {4}, affinity: {5}".format(
+        settings["cpus"], settings["torch_threads"], settings["torch_interop_threads"], settings["blas_threads"],
+        settings["dip_workers"], affinity)
+
+
+def parse_cpu_list(value):
+    """Parse a core list such as '0-7,16,18' into a list of ints"""
+    cpus = []
+    for part in value.split(","):
+        if "-" in part:
+            start, end = part.split("-")
+            cpus.extend(range(int(start), int(end) + 1))
+        elif part:
+            cpus.append(int(part))
+    return cpus
@@ -0,0 +1,93 @@
+import numpy as np
+import torch
+
+
+def iterate_chunks(view, chunk_size):
+    """Rows of a view (tensor, memmap or array) as float32 numpy chunks"""
+    for start in range(0, view.shape[0], chunk_size):
+        chunk = view[start:start + chunk_size]
+        if isinstance(chunk, torch.Tensor):
+            chunk = chunk.numpy()
+        yield np.asarray(chunk, dtype=np.float32)
+
+
+def randomized_svd_components(view, rank, n_oversamples=10, n_iter=2, chunk_size=8192, random_state=0):
+    """
+    Top right singular vectors (n_features x rank) of a view by randomized subspace iteration.
+    Every iteration is one streaming pass over the rows, so the view never has to fit in memory twice.
+    """
+    rng = np.random.RandomState(random_state)
+    n_components = min(view.shape[1], rank + n_oversamples)
+    Q = rng.standard_normal((view.shape[1], n_components)).astype(np.float32)
+    for _ in range(n_iter + 1):
+        G = np.zeros_like(Q)
+        for chunk in iterate_chunks(view, chunk_size):
+            G += chunk.T @ (chunk @ Q)
+        Q, _ = np.linalg.qr(G)
+
+    # Eigen decomposition of Q^T A^T A Q gives the rotation of Q onto the singular vectors
+    S = np.zeros((n_components, n_components), dtype=np.float64)
+    for chunk in iterate_chunks(view, chunk_size):
+        P = chunk @ Q
+        S += P.T @ P
+    eigenvalues, W = np.linalg.eigh(S)
+    order = np.argsort(eigenvalues)[::-1][:rank]
+    return (Q @ W[:, order]).astype(np.float32)
+
+
+def highly_variable_features(view, rank, chunk_size=8192):
+    """Indices of the `rank` features with the highest variance, in their original order"""
+    n_samples = view.shape[0]
+    total = np.zeros(view.shape[1], dtype=np.float64)
+    total_sq = np.zeros(view.shape[1], dtype=np.float64)
+    for chunk in iterate_chunks(view, chunk_size):
+        total += chunk.sum(0)
+        total_sq += np.square(chunk, dtype=np.float64).sum(0)
+    variance = total_sq / n_samples - np.square(total / n_samples)
+    return np.sort(np.argsort(variance)[::-1][:rank])
+
+
+class ViewReducer():
+    """
+    Reduce every view to at most `rank` columns before it enters the encoders, either by projecting
+    on its top singular vectors ('svd') or by keeping its most variable features ('hvf').
+    The fitted projections are kept, so new data can be mapped into the same reduced space.
+    """
+
+    def __init__(self, method='svd', rank=256, n_oversamples=10, n_iter=2, chunk_size=8192, random_state=0):
+        assert method in ('svd', 'hvf'), "Unknown reduction method: {0}".format(method)
+        self.method = method
+        self.rank = rank
+        self.n_oversamples = n_oversamples
+        self.n_iter = n_iter
+        self.chunk_size = chunk_size
+        self.random_state = random_state
+
+    def fit(self, X):
+        # components_[v] is a projection matrix ('svd'), feature indices ('hvf') or None if the view is small
+        self.components_ = []
+        for view in X:
+            if view.shape[1] <= self.rank:
+                self.components_.append(None)
+            elif self.method == 'svd':
+                self.components_.append(randomized_svd_components(view, self.rank, self.n_oversamples, self.n_iter,
+                                                                  self.chunk_size, self.random_state))
+            else:
+                self.components_.append(highly_variable_features(view, self.rank, self.chunk_size))
+        return self
+
+    def transform(self, X):
+        X_reduced = []
+        for view, components in zip(X, self.components_):
+            if components is None:
+                X_reduced.append(view)
+            elif self.method == 'svd':
+                projected = [chunk @ components for chunk in iterate_chunks(view, self.chunk_size)]
+                X_reduced.append(torch.from_numpy(np.concatenate(projected, axis=0)))
+            else:
+                selected = [chunk[:, components] for chunk in iterate_chunks(view, self.chunk_size)]
+                X_reduced.append(torch.from_numpy(np.concatenate(selected, axis=0)))
+        return X_reduced
+
+    def fit_transform(self, X):
+        return self.fit(X).transform(X)
@@ -1,108 +1,190 @@
-from sklearn.metrics import normalized_mutual_info_score as nmi_score
-from sklearn.metrics import adjusted_rand_score as ari_score
 import argparse
+import os
+import numpy as np
+import torch
 import load_data as loader
+from checkpoint import Checkpointer, get_fingerprint, set_rng_state
 from datasets import TrainDataset
-from model import Network
-from utils import *
+from model import Network, bf16_autocast, get_encode_decode, get_quantized_encode
+from parallel import configure_threads, format_thread_settings, parse_cpu_list
+from reduction import ViewReducer
+from utils import cdist, create_data_loader, detect_device, encode_batchwise, get_center_labels, \
+    get_dip_matrix, get_nearest_points_to_optimal_centers, int_to_one_hot, judge_system, merge_by_dip_value, \
+    quantization_report, squared_euclidean_distance
+
+def get_epoch_tensors(centers_cpu, cluster_labels_cpu, dip_matrix_cpu, n_clusters_current, device):
+    centers_torch = []
+    cluster_labels_torch = torch.from_numpy(cluster_labels_cpu).long().to(device)
+    for v in range(2):
+        a = torch.from_numpy(centers_cpu[v]).float().to(device)
+        centers_torch.append(a)
+    dip_matrix_torch = torch.from_numpy(dip_matrix_cpu).float().to(device)
+    dip_matrix_eye = dip_matrix_torch + torch.eye(n_clusters_current, device=device)
+    dip_matrix_final = dip_matrix_eye / dip_matrix_eye.sum(1).reshape((-1, 1))
+    return centers_torch, cluster_labels_torch, dip_matrix_final
+
+
+def get_scUNC_loss(encode, decode, batch, ids, centers_torch, cluster_labels_torch, dip_matrix_final,
+                   n_clusters_current, i, cluster_loss_weight, ae_weight_loss, loss_fn, device, accelerated=False):
+    with bf16_autocast(device, enabled=accelerated):
+        embedded = encode(batch)
+        out1,out2 = decode(embedded)
+        embedded_centers_torch = encode(centers_torch)
+        # Reconstruction Loss
+        ae_loss = loss_fn(out1, batch[0]) + loss_fn(out2, batch[1])
+    return get_cluster_loss(ae_loss, embedded, embedded_centers_torch, ids, cluster_labels_torch, dip_matrix_final,
+                            n_clusters_current, i, cluster_loss_weight, ae_weight_loss)
+
+
+def get_cluster_loss(ae_loss, embedded, embedded_centers_torch, ids, cluster_labels_torch, dip_matrix_final,
+                     n_clusters_current, i, cluster_loss_weight, ae_weight_loss):
+    # The cluster loss is computed in float32
+    embedded = embedded.float()
+    embedded_centers_torch = embedded_centers_torch.float()
+    # Get distances between points and centers. Get nearest center
+    squared_diffs = squared_euclidean_distance(embedded_centers_torch, embedded)
+    if i != 0:
+        # Update labels
+        current_labels = squared_diffs.argmin(1)
+    else:
+        k = np.array(ids[0])
+        current_labels = cluster_labels_torch[k]
+
+    onehot_labels = int_to_one_hot(current_labels, n_clusters_current).float()
+    cluster_relationships = torch.matmul(onehot_labels, dip_matrix_final)
+    escaped_diffs = cluster_relationships * squared_diffs
+
+    # Normalize loss by cluster distances
+    squared_center_diffs = squared_euclidean_distance(embedded_centers_torch, embedded_centers_torch)
+
+    # Ignore zero values (diagonal)
+    mask = torch.where(squared_center_diffs != 0)
+    masked_center_diffs = squared_center_diffs[mask[0], mask[1]]
+    sqrt_masked_center_diffs = masked_center_diffs.sqrt()
+    masked_center_diffs_std = sqrt_masked_center_diffs.std() if len(sqrt_masked_center_diffs) > 2 else 0
+
+    # Loss function
+    cluster_loss = escaped_diffs.sum(1).mean() * (
+            1 + masked_center_diffs_std) / sqrt_masked_center_diffs.mean()
+    cluster_loss *= cluster_loss_weight
+
+
+    loss = ae_loss * ae_weight_loss + cluster_loss
+    return ae_loss, cluster_loss, loss, embedded
+
+
+def update_centers(X, embedded_data, encode, centers_torch, n_clusters_current, device, accelerated=False):
+    with bf16_autocast(device, enabled=accelerated):
+        embedded_centers_cpu = encode(centers_torch).detach().float().cpu().numpy()
+    cluster_labels_cpu = np.argmin(cdist(embedded_centers_cpu, embedded_data), axis=0)
+    optimal_centers = np.array([np.mean(embedded_data[cluster_labels_cpu == cluster_id], axis=0) for cluster_id in
+                                range(n_clusters_current)])
+    centers_cpu, embedded_centers_cpu = get_nearest_points_to_optimal_centers(X, optimal_centers, embedded_data)
+
+    # Update Dips
+    dip_matrix_cpu = get_dip_matrix(embedded_data, embedded_centers_cpu, cluster_labels_cpu, n_clusters_current)
+    return cluster_labels_cpu, centers_cpu, embedded_centers_cpu, dip_matrix_cpu
+
+
+def merge_clusters(X, embedded_data, i, n_clusters_current, cluster_labels_cpu, centers_cpu, embedded_centers_cpu,
+                   dip_matrix_cpu, dip_merge_threshold, n_clusters_min, debug):
+    # Start merging procedure
+    dip_argmax = np.unravel_index(np.argmax(dip_matrix_cpu, axis=None), dip_matrix_cpu.shape)
+
+    # Is merge possible?
+    if i != 0:
+        while dip_matrix_cpu[dip_argmax] >= dip_merge_threshold and n_clusters_current > n_clusters_min:
+            if debug:
+                print("Start merging in iteration {0}.\nMerging clusters {1} with dip value {2}.".format(i,
+                                                                                                         dip_argmax,
+                                                                                                         dip_matrix_cpu[
+                                                                                                             dip_argmax]))
+            # Reset iteration and reduce number of cluster
+            i = 0
+            n_clusters_current -= 1
+            cluster_labels_cpu, centers_cpu, embedded_centers_cpu, dip_matrix_cpu = \
+                merge_by_dip_value(X, embedded_data, cluster_labels_cpu, dip_argmax, n_clusters_current,
+                                    centers_cpu,  embedded_centers_cpu)
+            dip_argmax = np.unravel_index(np.argmax(dip_matrix_cpu, axis=None), dip_matrix_cpu.shape)
+    return i, n_clusters_current, cluster_labels_cpu, centers_cpu, dip_matrix_cpu
+
+
+def print_iteration(i, n_clusters_current, ae_loss, cluster_loss, loss, dip_matrix_cpu):
+    print(
+        "Iteration {0}  (n_clusters = {4}) - reconstruction loss: {1} / cluster loss: {2} / total loss: {3}".format(
+            i, ae_loss.item(), cluster_loss.item(), loss.item(), n_clusters_current))
+    print("max dip", np.max(dip_matrix_cpu), " at ",
+          np.unravel_index(np.argmax(dip_matrix_cpu, axis=None), dip_matrix_cpu.shape))
+
 
 def scUNC_training(X,Y, n_clusters_current, dip_merge_threshold, cluster_loss_weight,ae_weight_loss, centers_cpu, cluster_labels_cpu,
                        dip_matrix_cpu, n_clusters_max, n_clusters_min, dedc_epochs, optimizer, loss_fn, autoencoder,
-                       device, dataloader, debug):
-    i = 0
+                       device, dataloader, debug, accelerated=False, quantized=False, checkpointer=None,
+                       start_iteration=0, epochs_done=0, reuse_embeddings=False, embedding_refresh_every=None):
+    encode, decode = get_encode_decode(autoencoder, compile=accelerated)
+    # N x D buffer collecting the embeddings of the training pass, see reuse_embeddings
+    embedding_buffer = None
+    i = start_iteration
+    if checkpointer is not None and epochs_done == 0:
+        # Resuming from here skips pretraining and the Louvain initialization
+        checkpointer.save(autoencoder, optimizer, epochs_done, i, n_clusters_current, centers_cpu,
+                          cluster_labels_cpu, dip_matrix_cpu)
     while i < dedc_epochs:
-        centers_torch = []
-        cluster_labels_torch = torch.from_numpy(cluster_labels_cpu).long().to(device)
-        for v in range(2):
-            a = torch.from_numpy(centers_cpu[v]).float().to(device)
-            centers_torch.append(a)
-        dip_matrix_torch = torch.from_numpy(dip_matrix_cpu).float().to(device)
-        dip_matrix_eye = dip_matrix_torch + torch.eye(n_clusters_current, device=device)
-        dip_matrix_final = dip_matrix_eye / dip_matrix_eye.sum(1).reshape((-1, 1))
+        centers_torch, cluster_labels_torch, dip_matrix_final = get_epoch_tensors(centers_cpu, cluster_labels_cpu,
+                                                                                  dip_matrix_cpu, n_clusters_current,
+                                                                                  device)
 
+        # The data loader is sequential, so a batch covers the samples [offset, offset + batch size)
+        offset = 0
         for batch, ids in dataloader:
             for w in range(2):
                 batch[w] = batch[w].to(device)
-            embedded = autoencoder.encode(batch)
-            out1,out2 = autoencoder.decode(embedded)
-            embedded_centers_torch = autoencoder.encode(centers_torch)
-            # Reconstruction Loss
-            ae_loss = loss_fn(out1, batch[0]) + loss_fn(out2, batch[1])
-            # Get distances between points and centers. Get nearest center
-            squared_diffs = squared_euclidean_distance(embedded_centers_torch, embedded)
-            if i != 0:
-                # Update labels
-                current_labels = squared_diffs.argmin(1)
-            else:
-                k = np.array(ids[0])
-                current_labels = cluster_labels_torch[k]
-
-            onehot_labels = int_to_one_hot(current_labels, n_clusters_current).float()
-            cluster_relationships = torch.matmul(onehot_labels, dip_matrix_final)
-            escaped_diffs = cluster_relationships * squared_diffs
-
-            # Normalize loss by cluster distances
-            squared_center_diffs = squared_euclidean_distance(embedded_centers_torch, embedded_centers_torch)
-
-            # Ignore zero values (diagonal)
-            mask = torch.where(squared_center_diffs != 0)
-            masked_center_diffs = squared_center_diffs[mask[0], mask[1]]
-            sqrt_masked_center_diffs = masked_center_diffs.sqrt()
-            masked_center_diffs_std = sqrt_masked_center_diffs.std() if len(sqrt_masked_center_diffs) > 2 else 0
-
-            # Loss function
-            cluster_loss = escaped_diffs.sum(1).mean() * (
-                    1 + masked_center_diffs_std) / sqrt_masked_center_diffs.mean()
-            cluster_loss *= cluster_loss_weight
-
-
-            loss = ae_loss * ae_weight_loss + cluster_loss
+            ae_loss, cluster_loss, loss, embedded = get_scUNC_loss(encode, decode, batch, ids, centers_torch,
+                                                                   cluster_labels_torch, dip_matrix_final,
+                                                                   n_clusters_current, i, cluster_loss_weight,
+                                                                   ae_weight_loss, loss_fn, device, accelerated)
+            if reuse_embeddings:
+                if embedding_buffer is None:
+                    embedding_buffer = np.empty((len(dataloader.dataset), embedded.shape[1]), dtype=np.float32)
+                embedding_buffer[offset:offset + embedded.shape[0]] = embedded.detach().cpu().numpy()
+                offset += embedded.shape[0]
             optimizer.zero_grad()
             loss.backward()
             optimizer.step()
 
 
         # Update centers
-        embedded_data = encode_batchwise(dataloader, autoencoder, device)
-
-
-        embedded_centers_cpu = autoencoder.encode(centers_torch).detach().cpu().numpy()
-        cluster_labels_cpu = np.argmin(cdist(embedded_centers_cpu, embedded_data), axis=0)
-        optimal_centers = np.array([np.mean(embedded_data[cluster_labels_cpu == cluster_id], axis=0) for cluster_id in
-                                    range(n_clusters_current)])
-        centers_cpu, embedded_centers_cpu = get_nearest_points_to_optimal_centers(X, optimal_centers, embedded_data)
-
-        # Update Dips
-        dip_matrix_cpu = get_dip_matrix(embedded_data, embedded_centers_cpu, cluster_labels_cpu, n_clusters_current)
+        refresh = not reuse_embeddings or (embedding_refresh_every is not None and
+                                           (epochs_done + 1) % embedding_refresh_every == 0)
+        if refresh:
+            embedded_data = encode_batchwise(dataloader, autoencoder, device, accelerated, quantized)
+        else:
+            # Embeddings from before each batch's optimizer step, at most one epoch old, from the same encode
+            # as the centers below
+            embedded_data = embedding_buffer
+        if quantized and refresh:
+            # Embed the centers with the same int8 copy as the data
+            cluster_labels_cpu, centers_cpu, embedded_centers_cpu, dip_matrix_cpu = \
+                update_centers(X, embedded_data, get_quantized_encode(autoencoder), centers_torch,
+                               n_clusters_current, device)
+        else:
+            cluster_labels_cpu, centers_cpu, embedded_centers_cpu, dip_matrix_cpu = \
+                update_centers(X, embedded_data, encode, centers_torch, n_clusters_current, device, accelerated)
 
         if debug:
-            print(
-                "Iteration {0}  (n_clusters = {4}) - reconstruction loss: {1} / cluster loss: {2} / total loss: {3}".format(
-                    i, ae_loss.item(), cluster_loss.item(), loss.item(), n_clusters_current))
-            print("max dip", np.max(dip_matrix_cpu), " at ",
-                  np.unravel_index(np.argmax(dip_matrix_cpu, axis=None), dip_matrix_cpu.shape))
+            print_iteration(i, n_clusters_current, ae_loss, cluster_loss, loss, dip_matrix_cpu)
 
 
         i += 1
 
-        # Start merging procedure
-        dip_argmax = np.unravel_index(np.argmax(dip_matrix_cpu, axis=None), dip_matrix_cpu.shape)
-
-        # Is merge possible?
-        if i != 0:
-            while dip_matrix_cpu[dip_argmax] >= dip_merge_threshold and n_clusters_current > n_clusters_min:
-                if debug:
-                    print("Start merging in iteration {0}.\nMerging clusters {1} with dip value {2}.".format(i,
-                                                                                                             dip_argmax,
-                                                                                                             dip_matrix_cpu[
-                                                                                                                 dip_argmax]))
-                # Reset iteration and reduce number of cluster
-                i = 0
-                n_clusters_current -= 1
-                cluster_labels_cpu, centers_cpu, embedded_centers_cpu, dip_matrix_cpu = \
-                    merge_by_dip_value(X, embedded_data, cluster_labels_cpu, dip_argmax, n_clusters_current,
-                                        centers_cpu,  embedded_centers_cpu)
-                dip_argmax = np.unravel_index(np.argmax(dip_matrix_cpu, axis=None), dip_matrix_cpu.shape)
+        i, n_clusters_current, cluster_labels_cpu, centers_cpu, dip_matrix_cpu = \
+            merge_clusters(X, embedded_data, i, n_clusters_current, cluster_labels_cpu, centers_cpu,
+                           embedded_centers_cpu, dip_matrix_cpu, dip_merge_threshold, n_clusters_min, debug)
+
+        epochs_done += 1
+        if checkpointer is not None and checkpointer.is_due(epochs_done):
+            checkpointer.save(autoencoder, optimizer, epochs_done, i, n_clusters_current, centers_cpu,
+                              cluster_labels_cpu, dip_matrix_cpu)
 
 
         if n_clusters_current == 1:
@@ -113,27 +195,34 @@ def scUNC_training(X,Y, n_clusters_current, dip_merge_threshold, cluster_loss_we
     return cluster_labels_cpu, n_clusters_current, centers_cpu, autoencoder
 
 
-def get_trained_autoencoder(trainloader, learning_rate, n_epochs, device, optimizer_class, loss_fn,
-                            input_dim1,input_dim2, embedding_size, autoencoder_class=Network):
-
+def build_autoencoder(input_dim1, input_dim2, embedding_size, device, autoencoder_class=Network):
     if judge_system():
         act_fn = torch.nn.ReLU
     else:
         act_fn = torch.nn.LeakyReLU
 
 
-    autoencoder = autoencoder_class(input_A=input_dim1, input_B=input_dim2, embedding_size=embedding_size,
-                                    act_fn=act_fn).to(device)
+    return autoencoder_class(input_A=input_dim1, input_B=input_dim2, embedding_size=embedding_size,
+                             act_fn=act_fn).to(device)
+
+
+def get_trained_autoencoder(trainloader, learning_rate, n_epochs, device, optimizer_class, loss_fn,
+                            input_dim1,input_dim2, embedding_size, autoencoder_class=Network, accelerated=False):
+
+    autoencoder = build_autoencoder(input_dim1, input_dim2, embedding_size, device, autoencoder_class)
 
     optimizer = optimizer_class(autoencoder.parameters(), lr=learning_rate)
-    autoencoder.start_training(trainloader, n_epochs, device, optimizer, loss_fn)
+    autoencoder.start_training(trainloader, n_epochs, device, optimizer, loss_fn, accelerated)
 
     return autoencoder
 
-def _scUNC(X, Y, dip_merge_threshold, cluster_loss_weight, ae_weight_loss, n_clusters_max,
-             n_clusters_min, batch_size, learning_rate, pretrain_epochs, dedc_epochs, embedding_size,
-               debug, optimizer_class=torch.optim.Adam, loss_fn=torch.nn.MSELoss()):
-
+def initialize_scUNC(X, Y, batch_size, learning_rate, pretrain_epochs, embedding_size,
+                     optimizer_class=torch.optim.Adam, loss_fn=torch.nn.MSELoss(), accelerated=False,
+                     quantized=False):
+    """
+    Pretrain the autoencoder and get the initial micro-clusters. This part does not depend on
+    dip_merge_threshold, cluster_loss_weight or ae_loss_weight and can be shared between runs.
+    """
     device = detect_device()
 
     dataset = TrainDataset(X, Y)
@@ -143,11 +232,11 @@ def _scUNC(X, Y, dip_merge_threshold, cluster_loss_weight, ae_weight_loss, n_clu
 
 
     autoencoder = get_trained_autoencoder(dataloader, learning_rate, pretrain_epochs, device,
-                                              optimizer_class, loss_fn, args.view_dims[0],args.view_dims[1], embedding_size,
-                                              Network)
+                                              optimizer_class, loss_fn, X[0].shape[1], X[1].shape[1], embedding_size,
+                                              Network, accelerated)
 
 
-    embedded_data = encode_batchwise(dataloader, autoencoder, device)
+    embedded_data = encode_batchwise(dataloader, autoencoder, device, accelerated, quantized)
 
     # Execute Louvain algorithm to get initial micro-clusters in embedded space
     init_centers, cluster_labels_cpu = get_center_labels(embedded_data, resolution=3.0)
@@ -160,9 +249,36 @@ def _scUNC(X, Y, dip_merge_threshold, cluster_loss_weight, ae_weight_loss, n_clu
     # Initial dip values
     dip_matrix_cpu = get_dip_matrix(embedded_data, embedded_centers_cpu, cluster_labels_cpu, n_clusters_start)
 
+    return autoencoder, dataloader, device, n_clusters_start, centers_cpu, cluster_labels_cpu, dip_matrix_cpu
+
+
+def _scUNC(X, Y, dip_merge_threshold, cluster_loss_weight, ae_weight_loss, n_clusters_max,
+             n_clusters_min, batch_size, learning_rate, pretrain_epochs, dedc_epochs, embedding_size,
+               debug, optimizer_class=torch.optim.Adam, loss_fn=torch.nn.MSELoss(), accelerated=False,
+               quantized=False, checkpointer=None, reuse_embeddings=False, embedding_refresh_every=None):
+
     # Reduce learning_rate from pretraining by a magnitude of 10
     dedc_learning_rate = learning_rate * 0.1
-    optimizer = optimizer_class(autoencoder.parameters(), lr=dedc_learning_rate)
+    if checkpointer is not None and checkpointer.exists():
+        state = checkpointer.load()
+        print("Resuming from checkpoint {0} (epoch {1}, n_clusters = {2})".format(
+            checkpointer.path, state['epochs_done'], state['n_clusters_current']))
+        device = detect_device()
+        dataloader = create_data_loader(TrainDataset(X, Y), batch_size, init=True, labels=None)
+        autoencoder = build_autoencoder(X[0].shape[1], X[1].shape[1], embedding_size, device)
+        autoencoder.load_state_dict(state['autoencoder'])
+        optimizer = optimizer_class(autoencoder.parameters(), lr=dedc_learning_rate)
+        optimizer.load_state_dict(state['optimizer'])
+        set_rng_state(state['rng'])
+        n_clusters_start, centers_cpu, cluster_labels_cpu, dip_matrix_cpu = state['n_clusters_current'], \
+            state['centers_cpu'], state['cluster_labels_cpu'], state['dip_matrix_cpu']
+        start_iteration, epochs_done = state['i'], state['epochs_done']
+    else:
+        autoencoder, dataloader, device, n_clusters_start, centers_cpu, cluster_labels_cpu, dip_matrix_cpu = \
+            initialize_scUNC(X, Y, batch_size, learning_rate, pretrain_epochs, embedding_size, optimizer_class,
+                             loss_fn, accelerated, quantized)
+        optimizer = optimizer_class(autoencoder.parameters(), lr=dedc_learning_rate)
+        start_iteration, epochs_done = 0, 0
 
     # Start clustering training
     cluster_labels_cpu, n_clusters_current, centers_cpu, autoencoder = scUNC_training(X,Y, n_clusters_start,
@@ -180,7 +296,17 @@ def _scUNC(X, Y, dip_merge_threshold, cluster_loss_weight, ae_weight_loss, n_clu
                                                                                           autoencoder,
                                                                                           device,
                                                                                           dataloader,
-                                                                                          debug)
+                                                                                          debug,
+                                                                                          accelerated,
+                                                                                          quantized,
+                                                                                          checkpointer,
+                                                                                          start_iteration,
+                                                                                          epochs_done,
+                                                                                          reuse_embeddings,
+                                                                                          embedding_refresh_every)
+    if checkpointer is not None:
+        # A finished run is not resumed
+        checkpointer.remove()
 
     return cluster_labels_cpu, n_clusters_current, centers_cpu, autoencoder
 
@@ -189,7 +315,10 @@ class scUNC():
 
     def __init__(self, dip_merge_threshold, cluster_loss_weight, ae_loss_weight,  batch_size,
                  learning_rate, pretrain_epochs, dedc_epochs, embedding_size,
-                 n_clusters_max, n_clusters_min, debug):
+                 n_clusters_max, n_clusters_min, debug, torch_threads=None, torch_interop_threads=None,
+                 blas_threads=None, dip_workers=None, cpu_affinity=None, accelerated=False, reduction=None,
+                 reduction_rank=256, quantized_encode=False, checkpoint_path=None, checkpoint_every=None,
+                 checkpoint_interval=None, reuse_embeddings=False, embedding_refresh_every=None):
 
         self.dip_merge_threshold = dip_merge_threshold
         self.cluster_loss_weight = cluster_loss_weight
@@ -202,8 +331,41 @@ class scUNC():
         self.dedc_epochs = dedc_epochs
         self.embedding_size = embedding_size
         self.debug = debug
+        self.torch_threads = torch_threads
+        self.torch_interop_threads = torch_interop_threads
+        self.blas_threads = blas_threads
+        self.dip_workers = dip_workers
+        self.cpu_affinity = cpu_affinity
+        self.accelerated = accelerated
+        self.reduction = reduction
+        self.reduction_rank = reduction_rank
+        self.quantized_encode = quantized_encode
+        # fit resumes from checkpoint_path if it exists and was written for the same data and hyperparameters
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_interval = checkpoint_interval
+        # Reuse the embeddings of the training pass for the center and dip update instead of re-encoding,
+        # with an exact pass every embedding_refresh_every epochs
+        self.reuse_embeddings = reuse_embeddings
+        self.embedding_refresh_every = embedding_refresh_every
 
     def fit(self, X,Y):
+        self.thread_settings_ = configure_threads(self.torch_threads, self.torch_interop_threads, self.blas_threads,
+                                                  self.dip_workers, self.cpu_affinity)
+        print(format_thread_settings(self.thread_settings_))
+        self.reducer_ = None
+        if self.reduction is not None:
+            # Fit, centers and predict all work in the reduced space
+            self.reducer_ = ViewReducer(self.reduction, self.reduction_rank)
+            X = self.reducer_.fit_transform(X)
+        quantized = self.quantized_encode
+        if quantized and detect_device().type != 'cpu':
+            print("[WARNING] The int8 quantized encoder runs on CPU only and is not used.")
+            quantized = False
+        checkpointer = None
+        if self.checkpoint_path is not None:
+            checkpointer = Checkpointer(self.checkpoint_path, self.checkpoint_every, self.checkpoint_interval,
+                                        self.get_fingerprint(X, Y))
         labels, n_clusters, centers, autoencoder = _scUNC(X,Y, self.dip_merge_threshold,
                                                                self.cluster_loss_weight,
                                                                self.ae_loss_weight,
@@ -214,63 +376,141 @@ class scUNC():
                                                                self.pretrain_epochs,
                                                                self.dedc_epochs,
                                                                self.embedding_size,
-                                                               self.debug)
+                                                               self.debug,
+                                                               accelerated=self.accelerated,
+                                                               quantized=quantized,
+                                                               checkpointer=checkpointer,
+                                                               reuse_embeddings=self.reuse_embeddings,
+                                                               embedding_refresh_every=self.embedding_refresh_every)
 
         self.labels_ = labels
         self.n_clusters_ = n_clusters
         self.cluster_centers_ = centers
         self.autoencoder = autoencoder
+        if quantized:
+            dataloader = create_data_loader(TrainDataset(X, Y), self.batch_size, init=True)
+            self.quantization_report_ = quantization_report(dataloader, autoencoder, detect_device(), centers)
+            print("int8 encoder - embedding drift: {drift:.4f}, label agreement: {agreement:.4f}, "
+                  "pass time: {int8_time:.2f}s (float32 {fp32_time:.2f}s)".format(**self.quantization_report_))
 
         return labels, n_clusters
 
+    def get_fingerprint(self, X, Y):
+        """Fingerprint of the data and of every hyperparameter that changes the clustering, see checkpoint.py"""
+        params = dict(dip_merge_threshold=self.dip_merge_threshold, cluster_loss_weight=self.cluster_loss_weight,
+                      ae_loss_weight=self.ae_loss_weight, n_clusters_max=self.n_clusters_max,
+                      n_clusters_min=self.n_clusters_min, batch_size=self.batch_size,
+                      learning_rate=self.learning_rate, pretrain_epochs=self.pretrain_epochs,
+                      dedc_epochs=self.dedc_epochs, embedding_size=self.embedding_size, accelerated=self.accelerated,
+                      reduction=self.reduction, reduction_rank=self.reduction_rank,
+                      quantized_encode=self.quantized_encode, reuse_embeddings=self.reuse_embeddings,
+                      embedding_refresh_every=self.embedding_refresh_every)
+        return get_fingerprint(X, Y, params)
+
+    def predict(self, X):
+        """Assign samples to the nearest embedded cluster center, with dropout disabled"""
+        if self.reducer_ is not None:
+            X = self.reducer_.transform(X)
+        device = detect_device()
+        dummy_labels = [np.zeros(X[0].shape[0]) for _ in X]
+        dataloader = create_data_loader(TrainDataset(X, dummy_labels), self.batch_size, init=True)
+        centers_torch = [torch.from_numpy(np.asarray(c)).float().to(device) for c in self.cluster_centers_]
+        was_training = self.autoencoder.training
+        self.autoencoder.eval()
+        with torch.no_grad():
+            embedded_data = encode_batchwise(dataloader, self.autoencoder, device, self.accelerated)
+            with bf16_autocast(device, enabled=self.accelerated):
+                embedded_centers = self.autoencoder.encode(centers_torch).float().cpu().numpy()
+        self.autoencoder.train(was_training)
+        return np.argmin(cdist(embedded_centers, embedded_data), axis=0)
+
+
+def evaluate_clustering(labels, cluster_labels):
+    """ARI, NMI, ACC and purity of predicted cluster labels, rounded to 4 digits"""
+    from metrics import evaluate
+
+    return {name: float(np.round(value, 4)) for name, value in evaluate(labels, cluster_labels).items()}
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='scUNC')
+    parser.add_argument('--dataset', nargs='*', default=list(loader.ALL_data), choices=list(loader.ALL_data))
+    parser.add_argument('--dip_merge_threshold', type=float, default=1)
+    parser.add_argument('--cluster_loss_weight', type=float, default=0.1)
+    parser.add_argument('--ae_loss_weight', type=float, default=100)
+    parser.add_argument('--n_clusters_max', type=int, default=np.inf)
+    parser.add_argument('--n_clusters_min', type=int, default=3)
+    parser.add_argument('--batch_size', type=int, default=1024)
+    parser.add_argument('--learning_rate', type=float, default=1e-4)
+    parser.add_argument('--pretrain_epochs', type=int, default=100)
+    parser.add_argument('--dedc_epochs', type=int, default=50)
+    parser.add_argument('--embedding_size', type=int, default=100)
+    parser.add_argument('--debug', type=bool, default=True)
+    parser.add_argument('--torch_threads', type=int, default=None)
+    parser.add_argument('--torch_interop_threads', type=int, default=None)
+    parser.add_argument('--blas_threads', type=int, default=None)
+    parser.add_argument('--dip_workers', type=int, default=None)
+    parser.add_argument('--cpu_affinity', type=parse_cpu_list, default=None, help="cores to pin to, e.g. 0-7,16")
+    parser.add_argument('--accelerated', action='store_true', help="torch.compile and bfloat16 autocast")
+    parser.add_argument('--cache', action='store_true', help="load the views from the memory-mapped binary cache")
+    parser.add_argument('--cache_dtype', default='float32', choices=['float32', 'float16'])
+    parser.add_argument('--reduction', default=None, choices=['svd', 'hvf'],
+                        help="reduce every view with randomized SVD or highly variable feature selection")
+    parser.add_argument('--reduction_rank', type=int, default=256)
+    parser.add_argument('--quantized_encode', action='store_true',
+                        help="use a dynamically int8 quantized encoder for full-dataset embedding passes "
+                             "(with --reuse_embeddings only on the refresh passes)")
+    parser.add_argument('--checkpoint_dir', default=None,
+                        help="checkpoint the clustering state to <dir>/<dataset>-<fingerprint>.pt and resume from "
+                             "it; the fingerprint covers the data and the hyperparameters")
+    parser.add_argument('--checkpoint_every', type=int, default=None, help="checkpoint every n epochs")
+    parser.add_argument('--checkpoint_interval', type=float, default=None, help="checkpoint every n seconds")
+    parser.add_argument('--reuse_embeddings', action='store_true',
+                        help="update centers and dips from the embeddings of the training pass")
+    parser.add_argument('--embedding_refresh_every', type=int, default=None,
+                        help="with --reuse_embeddings, re-encode the data exactly every n epochs")
+    parser.add_argument('--seed', type=int, default=None,
+                        help="seed of the cell shuffle and the training; 0 if omitted with --checkpoint_dir, "
+                             "so that a resumed run sees the cells in the same order")
+    return parser
+
 
 if __name__ == "__main__":
-    my_data_dic = loader.ALL_data
-    for i_d in my_data_dic:
-        data_para = my_data_dic[i_d]
-        device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-        parser = argparse.ArgumentParser(description='scUNC')
-        parser.add_argument('--dataset', default=data_para)
-        parser.add_argument("--view_dims", default=data_para['n_input'])
-        parser.add_argument('--name', type=str, default=data_para[1])
-        parser.add_argument('--dip_merge_threshold', type=float, default=1)
-        parser.add_argument('--cluster_loss_weight', type=float, default=0.1)
-        parser.add_argument('--ae_loss_weight', type=float, default=100)
-        parser.add_argument('--n_clusters_max', type=int, default=np.inf)
-        parser.add_argument('--n_clusters_min', type=int, default=3)
-        parser.add_argument('--batch_size', type=int, default=1024)
-        parser.add_argument('--learning_rate ', type=float, default=1e-4)
-        parser.add_argument('--pretrain_epochs', type=float, default=100)
-        parser.add_argument('--dedc_epochs', type=float, default=50)
-        parser.add_argument('--embedding_size ', type=float, default=100)
-        parser.add_argument('--debug', type=bool, default=True)
-        args = parser.parse_args()
-        X, Y = loader.load_data(args.dataset)
+    args = get_parser().parse_args()
+    seed = 0 if args.seed is None and args.checkpoint_dir is not None else args.seed
+    for i_d in args.dataset:
+        data_para = loader.ALL_data[i_d]
+        if seed is not None:
+            np.random.seed(seed)
+            torch.manual_seed(seed)
+        X, Y = loader.load_data(data_para, cache=args.cache, dtype=args.cache_dtype)
         labels = Y[0].copy().astype(np.int32)
 
 
         # Training
-        myscUNC = scUNC(dip_merge_threshold=args.dip_merge_threshold, cluster_loss_weight=args. cluster_loss_weight,ae_loss_weight=args.ae_loss_weight,batch_size=args.batch_size,
-                        learning_rate=1e-4,pretrain_epochs=args.pretrain_epochs,dedc_epochs=args.dedc_epochs,
-                        embedding_size=100, n_clusters_max=args.n_clusters_max,
-                        n_clusters_min=args.n_clusters_min, debug=args.debug)
+        myscUNC = scUNC(dip_merge_threshold=args.dip_merge_threshold, cluster_loss_weight=args.cluster_loss_weight,
+                        ae_loss_weight=args.ae_loss_weight, batch_size=args.batch_size,
+                        learning_rate=args.learning_rate, pretrain_epochs=args.pretrain_epochs,
+                        dedc_epochs=args.dedc_epochs, embedding_size=args.embedding_size,
+                        n_clusters_max=args.n_clusters_max, n_clusters_min=args.n_clusters_min, debug=args.debug,
+                        torch_threads=args.torch_threads, torch_interop_threads=args.torch_interop_threads,
+                        blas_threads=args.blas_threads, dip_workers=args.dip_workers, cpu_affinity=args.cpu_affinity,
+                        accelerated=args.accelerated, reduction=args.reduction,
+                        reduction_rank=args.reduction_rank, quantized_encode=args.quantized_encode,
+                        checkpoint_every=args.checkpoint_every, checkpoint_interval=args.checkpoint_interval,
+                        reuse_embeddings=args.reuse_embeddings, embedding_refresh_every=args.embedding_refresh_every)
+        if args.checkpoint_dir is not None:
+            myscUNC.checkpoint_path = os.path.join(args.checkpoint_dir, "{0}-{1}.pt".format(
+                i_d, myscUNC.get_fingerprint(X, Y)[:16]))
 
         cluster_labels, estimated_cluster_numbers = myscUNC.fit(X,Y)
 
         # === Print results ===
-        ari = float(np.round(ari_score(labels, cluster_labels), 4))
-        nmi = float(np.round(nmi_score(labels, cluster_labels), 4))
-        acc = float(np.round(cluster_acc(labels, cluster_labels), 4))
-        pur = float(np.round(Purity_score(labels, cluster_labels), 4))
-        
-        
-        print("The estimated number of clusters:", estimated_cluster_numbers)
-        print("ARI: ", ari)
-        print("NMI:", nmi)
-        print("ACC: ", acc)
-        print("PUR: ", pur)
-        
-
-
-
+        scores = evaluate_clustering(labels, cluster_labels)
 
+        print("Dataset:", data_para[1])
+        print("The estimated number of clusters:", estimated_cluster_numbers)
+        print("ARI: ", scores['ari'])
+        print("NMI:", scores['nmi'])
+        print("ACC: ", scores['acc'])
+        print("PUR: ", scores['pur'])
@@ -0,0 +1,120 @@
+"""
+Warm-start hyperparameter sweep: pretrain the autoencoder and run the Louvain initialization once,
+then run the clustering phase (scUNC_training) for every configuration on a copy of that state.
+"""
+import argparse
+import copy
+import itertools
+import time
+import numpy as np
+import torch
+from datasets import TrainDataset
+from parallel import available_cpus, configure_threads
+from run_scUNC import evaluate_clustering, initialize_scUNC, scUNC_training
+from utils import create_data_loader, detect_device
+
+DEFAULT_CONFIG = dict(dip_merge_threshold=1, cluster_loss_weight=0.1, ae_loss_weight=100)
+
+# State shared by all configurations of a sweep, set once per worker
+_SHARED = None
+
+
+def init_sweep_worker(shared, threads_per_worker=None):
+    global _SHARED
+    if threads_per_worker is not None:
+        configure_threads(torch_threads=threads_per_worker, blas_threads=threads_per_worker, dip_workers=1)
+    _SHARED = shared
+
+
+def run_config(config):
+    shared = _SHARED
+    config = dict(DEFAULT_CONFIG, **config)
+    torch.manual_seed(config.get("seed", 0))
+    np.random.seed(config.get("seed", 0))
+
+    device = detect_device()
+    dataloader = create_data_loader(TrainDataset(shared["X"], shared["Y"]), shared["batch_size"], init=True)
+    autoencoder = copy.deepcopy(shared["autoencoder"]).to(device)
+    optimizer = torch.optim.Adam(autoencoder.parameters(), lr=shared["learning_rate"] * 0.1)
+
+    start = time.perf_counter()
+    cluster_labels, n_clusters, _, _ = scUNC_training(shared["X"], shared["Y"], shared["n_clusters_start"],
+                                                      config["dip_merge_threshold"], config["cluster_loss_weight"],
+                                                      config["ae_loss_weight"], copy.deepcopy(shared["centers_cpu"]),
+                                                      shared["cluster_labels_cpu"].copy(),
+                                                      shared["dip_matrix_cpu"].copy(), shared["n_clusters_max"],
+                                                      shared["n_clusters_min"], shared["dedc_epochs"], optimizer,
+                                                      torch.nn.MSELoss(), autoencoder, device, dataloader,
+                                                      shared["debug"], shared["accelerated"])
+    result = dict(config, n_clusters=n_clusters, time=round(time.perf_counter() - start, 3), labels=cluster_labels)
+    if shared["labels"] is not None:
+        result.update(evaluate_clustering(shared["labels"], cluster_labels))
+    return result
+
+
+def warm_start_sweep(X, Y, configs, batch_size=1024, learning_rate=1e-4, pretrain_epochs=100, dedc_epochs=50,
+                     embedding_size=100, n_clusters_max=np.inf, n_clusters_min=3, labels=None, n_workers=1,
+                     threads_per_worker=None, debug=False, accelerated=False):
+    """
+    Run scUNC for several settings of dip_merge_threshold, cluster_loss_weight and ae_loss_weight
+    while pretraining and initializing only once.
+
+    :param configs: list of dicts overriding DEFAULT_CONFIG, optionally with a 'seed'
+    :param labels: ground truth; if given, ARI/NMI/ACC/purity are added to each result
+    :param n_workers: number of processes running the clustering phases in parallel
+    :return: list of result dicts (config, labels, n_clusters, time and metrics) in the order of configs,
+             and the time spent on pretraining and initialization
+    """
+    start = time.perf_counter()
+    autoencoder, _, _, n_clusters_start, centers_cpu, cluster_labels_cpu, dip_matrix_cpu = \
+        initialize_scUNC(X, Y, batch_size, learning_rate, pretrain_epochs, embedding_size, accelerated=accelerated)
+    init_time = time.perf_counter() - start
+
+    shared = dict(X=X, Y=Y, autoencoder=autoencoder.cpu(), n_clusters_start=n_clusters_start,
+                  centers_cpu=centers_cpu, cluster_labels_cpu=cluster_labels_cpu, dip_matrix_cpu=dip_matrix_cpu,
+                  batch_size=batch_size, learning_rate=learning_rate, dedc_epochs=dedc_epochs,
+                  n_clusters_max=n_clusters_max, n_clusters_min=n_clusters_min, labels=labels, debug=debug,
+                  accelerated=accelerated)
+
+    if n_workers == 1:
+        init_sweep_worker(shared)
+        results = [run_config(config) for config in configs]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        import torch.multiprocessing as mp
+
+        if threads_per_worker is None:
+            threads_per_worker = max(1, available_cpus() // n_workers)
+        # Tensors of the shared state are passed through shared memory by torch.multiprocessing
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=mp.get_context("spawn"),
+                                 initializer=init_sweep_worker, initargs=(shared, threads_per_worker)) as pool:
+            results = list(pool.map(run_config, configs))
+    return results, init_time
+
+
+if __name__ == "__main__":
+    import load_data as loader
+
+    parser = argparse.ArgumentParser(description='scUNC warm-start sweep')
+    parser.add_argument('--dataset', default='SMAGE3K', choices=list(loader.ALL_data))
+    parser.add_argument('--dip_merge_threshold', type=float, nargs='+', default=[DEFAULT_CONFIG['dip_merge_threshold']])
+    parser.add_argument('--cluster_loss_weight', type=float, nargs='+', default=[DEFAULT_CONFIG['cluster_loss_weight']])
+    parser.add_argument('--ae_loss_weight', type=float, nargs='+', default=[DEFAULT_CONFIG['ae_loss_weight']])
+    parser.add_argument('--pretrain_epochs', type=int, default=100)
+    parser.add_argument('--dedc_epochs', type=int, default=50)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--threads_per_worker', type=int, default=None)
+    args = parser.parse_args()
+
+    X, Y = loader.load_data(loader.ALL_data[args.dataset])
+    configs = [dict(dip_merge_threshold=t, cluster_loss_weight=c, ae_loss_weight=a) for t, c, a in
+               itertools.product(args.dip_merge_threshold, args.cluster_loss_weight, args.ae_loss_weight)]
+    results, init_time = warm_start_sweep(X, Y, configs, pretrain_epochs=args.pretrain_epochs,
+                                          dedc_epochs=args.dedc_epochs, labels=Y[0].copy().astype(np.int32),
+                                          n_workers=args.workers, threads_per_worker=args.threads_per_worker)
+
+    print("Pretraining and initialization: {0:.1f}s".format(init_time))
+    for r in results:
+        print("threshold {0}, cluster weight {1}, ae weight {2}: K = {3}, ARI = {4}, NMI = {5}, ACC = {6}, "
+              "PUR = {7} ({8}s)".format(r['dip_merge_threshold'], r['cluster_loss_weight'], r['ae_loss_weight'],
+                                        r['n_clusters'], r['ari'], r['nmi'], r['acc'], r['pur'], r['time']))
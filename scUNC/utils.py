@@ -1,22 +1,24 @@
 import os
 import ctypes
 import platform
-import scanpy as sc
-import pandas as pd
-from anndata import AnnData
-from scipy.spatial.distance import cdist
 import torch
-import mkl
 import numpy as np
-from scipy.optimize import linear_sum_assignment
-from sklearn import metrics
 from torch.utils.data import DataLoader
+import parallel
+# scanpy, pandas, anndata and scipy are imported inside the functions
+# that need them (Louvain init, metrics, distances) to keep startup cheap.
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-mkl.get_max_threads()
 C_DIP_FILE = None
+
+
+def cdist(XA, XB, metric='euclidean'):
+    """Lazy wrapper around scipy.spatial.distance.cdist"""
+    from scipy.spatial.distance import cdist as _cdist
+    return _cdist(XA, XB, metric=metric)
+
 def cluster_acc(y_true, y_pred):
     """
-    Calculate clustering accuracy. Require scikit-learn installed
+    Calculate clustering accuracy. Require scipy installed
 
     # Arguments
         y: true labels, numpy.array with shape `(n_samples,)`
@@ -25,33 +27,16 @@ def cluster_acc(y_true, y_pred):
     # Return
         accuracy, in [0,1]
     """
-    y_true = y_true.astype(np.int64)
+    from metrics import accuracy_from_contingency, contingency_matrix
     assert y_pred.size == y_true.size
-    D = max(y_pred.max(), y_true.max()) + 1
-    w = np.zeros((D, D), dtype=np.int64)
-    for i in range(y_pred.size):
-        w[y_pred[i], y_true[i]] += 1
-    ind = linear_sum_assignment(w.max() - w)
-    ind = np.array((ind[0], ind[1])).T
-    return sum([w[i, j] for i, j in ind]) * 1.0 / y_pred.size
+    return accuracy_from_contingency(contingency_matrix(y_true, y_pred))
 
 
 def Purity_score(y_true, y_pred):
-    y_voted_labels = np.zeros(y_true.shape)
-    labels = np.unique(y_true)
-    ordered_labels = np.arange(labels.shape[0])
-    for k in range(labels.shape[0]):
-        y_true[y_true==labels[k]] = ordered_labels[k]
-    labels = np.unique(y_true)
-    bins = np.concatenate((labels, [np.max(labels)+1]), axis=0)
-
-    for cluster in np.unique(y_pred):
-        hist, _ = np.histogram(y_true[y_pred==cluster], bins=bins)
-        winner = np.argmax(hist)
-        y_voted_labels[y_pred==cluster] = winner
-
-    purity = metrics.accuracy_score(y_true, y_voted_labels)
-    return purity
+    from metrics import contingency_matrix, purity_from_contingency
+    return purity_from_contingency(contingency_matrix(y_true, y_pred))
+
+
 def create_data_loader(datasets, batch_size, init=False, labels=None):
     if init:
         return DataLoader(datasets, batch_size=batch_size)
@@ -74,18 +59,56 @@ def detect_device():
     return device
 
 
-def encode_batchwise(dataloader, model, device):
-    """ Utility function for embedding the whole data set in a mini-batch fashion
+def encode_batchwise(dataloader, model, device, accelerated=False, quantized=False):
+    """ Utility function for embedding the whole data set in a mini-batch fashion.
+    With quantized=True a dynamically int8 quantized copy of the model is used (CPU only).
     """
+    from model import bf16_autocast, get_encode_decode, get_quantized_encode
+    if quantized:
+        encode = get_quantized_encode(model)
+        device = torch.device('cpu')
+        accelerated = False
+    else:
+        encode, _ = get_encode_decode(model, compile=accelerated)
     embeddings = []
     for batch_idx, (xs, _) in enumerate(dataloader):
         for v in range(2):
-            xs[v] = torch.squeeze(xs[v]).to(device)
-        emb = model.encode(xs)
-        embeddings.append(emb.detach().cpu())
+            # Flatten the feature dims only, a squeeze would drop the batch dim of a one-sample batch
+            xs[v] = torch.flatten(xs[v], start_dim=1).to(device)
+        with bf16_autocast(device, enabled=accelerated):
+            emb = encode(xs)
+        embeddings.append(emb.detach().float().cpu())
     return torch.cat(embeddings, dim=0).numpy()
 
 
+def quantization_report(dataloader, model, device, centers):
+    """
+    Compare the int8 quantized bulk encoding with float32, with dropout disabled: relative drift of the
+    embeddings, agreement of the nearest-center labels and the time of both passes.
+    """
+    import time
+    from model import get_quantized_encode
+
+    centers_torch = [torch.from_numpy(np.asarray(c)).float() for c in centers]
+    was_training = model.training
+    model.eval()
+    with torch.no_grad():
+        start = time.perf_counter()
+        embedded = encode_batchwise(dataloader, model, device)
+        fp32_time = time.perf_counter() - start
+        start = time.perf_counter()
+        embedded_q = encode_batchwise(dataloader, model, device, quantized=True)
+        int8_time = time.perf_counter() - start
+        embedded_centers = model.encode([c.to(device) for c in centers_torch]).cpu().numpy()
+        embedded_centers_q = get_quantized_encode(model)(centers_torch).numpy()
+    model.train(was_training)
+
+    labels = np.argmin(cdist(embedded_centers, embedded), axis=0)
+    labels_q = np.argmin(cdist(embedded_centers_q, embedded_q), axis=0)
+    return dict(drift=float(np.linalg.norm(embedded_q - embedded) / np.linalg.norm(embedded)),
+                agreement=float(np.mean(labels == labels_q)), fp32_time=fp32_time, int8_time=int8_time)
+
+
 def int_to_one_hot(label_tensor, n_labels):
     onehot = torch.zeros([label_tensor.shape[0], n_labels], dtype=torch.float, device=label_tensor.device)
     onehot.scatter_(1, label_tensor.unsqueeze(1).long(), 1.0)
@@ -157,6 +180,10 @@ def get_center_labels(features, resolution=3.0):
           of communities.
     '''
 
+    import scanpy as sc
+    import pandas as pd
+    from anndata import AnnData
+
     print("\nInitializing cluster centroids using the louvain method.")
 
     adata0 = AnnData(features)
@@ -188,7 +215,8 @@ def dip_pval(data_dip, n_points):
         i0 = i1-1
 
     n0, n1 = N[[i0, i1]]
-    fn = float(n_points - n0) / (n1 - n0)
+    # n0 == n1 for clusters smaller than the table (e.g. emptied clusters)
+    fn = float(n_points - n0) / (n1 - n0) if n1 != n0 else 0.
     y0 = np.sqrt(n0) * CV[i0]
     y1 = np.sqrt(n1) * CV[i1]
     sD = np.sqrt(n_points) * data_dip
@@ -466,32 +494,48 @@ def merge_by_dip_value(X, embedded_data, cluster_labels_cpu, dip_argmax, n_clust
 def get_dip_matrix(data, dip_centers, dip_labels, n_clusters, max_cluster_size_diff_factor=3, min_sample_size=100):
     dip_matrix = np.zeros((n_clusters, n_clusters))
 
-    # Loop over all combinations of centers
-    for i in range(0, n_clusters - 1):
-        for j in range(i + 1, n_clusters):
-            center_diff = dip_centers[i] - dip_centers[j]
-            points_in_i = data[dip_labels == i]
-            points_in_j = data[dip_labels == j]
-            points_in_i_or_j = np.append(points_in_i, points_in_j, axis=0)
-            proj_points = np.dot(points_in_i_or_j, center_diff)
-            _, dip_p_value = dip_test(proj_points)
-
-            # Check if clusters sizes differ heavily
-            if points_in_i.shape[0] > points_in_j.shape[0] * max_cluster_size_diff_factor or \
-                    points_in_j.shape[0] > points_in_i.shape[0] * max_cluster_size_diff_factor:
-                if points_in_i.shape[0] > points_in_j.shape[0] * max_cluster_size_diff_factor:
-                    points_in_i = get_nearest_points(points_in_i, dip_centers[j], points_in_j.shape[0],
-                                                      max_cluster_size_diff_factor, min_sample_size)
-                elif points_in_j.shape[0] > points_in_i.shape[0] * max_cluster_size_diff_factor:
-                    points_in_j = get_nearest_points(points_in_j, dip_centers[i], points_in_i.shape[0],
-                                                      max_cluster_size_diff_factor, min_sample_size)
-                points_in_i_or_j = np.append(points_in_i, points_in_j, axis=0)
-                proj_points = np.dot(points_in_i_or_j, center_diff)
-                _, dip_p_value_2 = dip_test(proj_points)
-                dip_p_value = min(dip_p_value, dip_p_value_2)
-
-            # Add pval to dip matrix
-            dip_matrix[i][j] = dip_p_value
-            dip_matrix[j][i] = dip_p_value
+    # All combinations of centers
+    pairs = [(i, j) for i in range(0, n_clusters - 1) for j in range(i + 1, n_clusters)]
+    if parallel.DIP_WORKERS > 1 and len(pairs) > 1:
+        # The C dip test releases the GIL, so the pairs can be evaluated by a thread pool
+        if C_DIP_FILE is None:
+            load_c_dip_file()
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=parallel.DIP_WORKERS) as pool:
+            p_values = list(pool.map(lambda pair: get_dip_pval_of_pair(data, dip_centers, dip_labels, pair[0], pair[1],
+                                                                       max_cluster_size_diff_factor, min_sample_size),
+                                     pairs))
+    else:
+        p_values = [get_dip_pval_of_pair(data, dip_centers, dip_labels, i, j, max_cluster_size_diff_factor,
+                                         min_sample_size) for i, j in pairs]
+
+    # Add pvals to dip matrix
+    for (i, j), dip_p_value in zip(pairs, p_values):
+        dip_matrix[i][j] = dip_p_value
+        dip_matrix[j][i] = dip_p_value
 
     return dip_matrix
+
+
+def get_dip_pval_of_pair(data, dip_centers, dip_labels, i, j, max_cluster_size_diff_factor, min_sample_size):
+    center_diff = dip_centers[i] - dip_centers[j]
+    points_in_i = data[dip_labels == i]
+    points_in_j = data[dip_labels == j]
+    points_in_i_or_j = np.append(points_in_i, points_in_j, axis=0)
+    proj_points = np.dot(points_in_i_or_j, center_diff)
+    _, dip_p_value = dip_test(proj_points)
+
+    # Check if clusters sizes differ heavily
+    if points_in_i.shape[0] > points_in_j.shape[0] * max_cluster_size_diff_factor or \
+            points_in_j.shape[0] > points_in_i.shape[0] * max_cluster_size_diff_factor:
+        if points_in_i.shape[0] > points_in_j.shape[0] * max_cluster_size_diff_factor:
+            points_in_i = get_nearest_points(points_in_i, dip_centers[j], points_in_j.shape[0],
+                                              max_cluster_size_diff_factor, min_sample_size)
+        elif points_in_j.shape[0] > points_in_i.shape[0] * max_cluster_size_diff_factor:
+            points_in_j = get_nearest_points(points_in_j, dip_centers[i], points_in_i.shape[0],
+                                              max_cluster_size_diff_factor, min_sample_size)
+        points_in_i_or_j = np.append(points_in_i, points_in_j, axis=0)
+        proj_points = np.dot(points_in_i_or_j, center_diff)
+        _, dip_p_value_2 = dip_test(proj_points)
+        dip_p_value = min(dip_p_value, dip_p_value_2)
+    return dip_p_value